@@ -0,0 +1,194 @@
+import os
+import torch
+from tqdm import tqdm
+from transformer_lens import utils
+
+
+def _n_bytes(tensor):
+    return 0 if tensor is None else tensor.numel() * tensor.element_size()
+
+
+class AttentionPatternRecorder:
+    """
+    Captures hook_pattern for selected layers / heads / query positions and stores it compressed.
+    - mode="fp16": dense [layers, heads, queries, keys] in half precision
+    - mode="topk": per query row, only the top_k keys (fp16 values + int16/int32 key indices)
+    Full patterns are n_layers x n_heads x seq^2, so restricting queries to the final token /
+    answer positions is usually where most of the savings come from.
+    """
+    def __init__(self, model, layers=None, heads=None, query_positions=None, mode="fp16", top_k=8):
+        if mode not in ["fp16", "topk"]:
+            raise ValueError(f"Unknown storage mode {mode!r}, expected 'fp16' or 'topk'")
+        self.model = model
+        self.layers = list(range(model.cfg.n_layers)) if layers is None else list(layers)
+        self.heads = list(range(model.cfg.n_heads)) if heads is None else list(heads)
+        # ints; negative values count back from the end of the sequence. None = every query position
+        self.query_positions = query_positions
+        self.mode = mode
+        self.top_k = top_k
+
+    def _resolve_queries(self, seq_len, answer_len):
+        if self.query_positions is None:
+            positions = list(range(seq_len))
+        else:
+            positions = [p % seq_len for p in self.query_positions]
+        # the answer tokens sit at the very end when the answer is appended to the prompt
+        positions += list(range(seq_len - answer_len, seq_len))
+        return sorted(set(positions))
+
+    @torch.no_grad()
+    def _capture(self, tokens, query_idx):
+        """Dense fp32 patterns for the selection: [layers, heads, queries, keys]."""
+        captured = {}
+        head_idx = torch.tensor(self.heads, device=tokens.device)
+        q_idx = torch.tensor(query_idx, device=tokens.device)
+
+        def pattern_hook(pattern, hook):
+            captured[hook.layer()] = pattern[0, head_idx][:, q_idx].float()
+
+        self.model.run_with_hooks(
+            tokens,
+            return_type=None,
+            fwd_hooks=[(utils.get_act_name("pattern", layer), pattern_hook) for layer in self.layers],
+        )
+        return torch.stack([captured[layer] for layer in self.layers])
+
+    def _compress(self, dense):
+        """Returns (values, indices, reconstruction)."""
+        if self.mode == "fp16":
+            values = dense.half()
+            return values, None, values.float()
+
+        k = min(self.top_k, dense.shape[-1])
+        values, indices = dense.topk(k, dim=-1)
+        values = values.half()
+        index_dtype = torch.int16 if dense.shape[-1] <= torch.iinfo(torch.int16).max else torch.int32
+        reconstruction = torch.zeros_like(dense).scatter_(-1, indices, values.float())
+        return values, indices.to(index_dtype), reconstruction
+
+    def record(self, dataset, output_dir, append_answer=False, shard_size=256):
+        """
+        :param dataset: list[dict] of generator items (clean prompt is used)
+        :param append_answer: run on prompt + " " + answer and always keep the answer positions
+        :return: report with compression ratios and reconstruction error
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        print(f">> Recording attention patterns ({self.mode}) for {len(dataset)} items, "
+              f"{len(self.layers)} layers x {len(self.heads)} heads...")
+
+        report = {"stored_bytes": 0, "selected_fp32_bytes": 0, "full_fp32_bytes": 0,
+                  "max_abs_error": 0.0, "abs_error_sum": 0.0, "n_values": 0}
+        shard, shard_files, index = [], [], []
+
+        def flush():
+            path = os.path.join(output_dir, f"shard_{len(shard_files):05d}.pt")
+            torch.save(shard, path)
+            shard_files.append(os.path.basename(path))
+            shard.clear()
+
+        for i, task in enumerate(tqdm(dataset)):
+            text = task['clean']['prompt']
+            answer_len = 0
+            if append_answer:
+                prompt_len = self.model.to_tokens(text, prepend_bos=True).shape[1]
+                text += " " + task['clean']['answer']
+
+            tokens = self.model.to_tokens(text, prepend_bos=True)
+            seq_len = tokens.shape[1]
+            if append_answer:
+                # count the answer tokens in context: tokenized alone, sentencepiece splits the
+                # leading space differently than it does after the prompt
+                answer_len = seq_len - prompt_len
+            query_idx = self._resolve_queries(seq_len, answer_len)
+
+            dense = self._capture(tokens, query_idx)
+            values, indices, reconstruction = self._compress(dense)
+
+            error = (reconstruction - dense).abs()
+            report["max_abs_error"] = max(report["max_abs_error"], error.max().item())
+            report["abs_error_sum"] += error.sum().item()
+            report["n_values"] += error.numel()
+            report["stored_bytes"] += _n_bytes(values) + _n_bytes(indices)
+            report["selected_fp32_bytes"] += dense.numel() * 4
+            report["full_fp32_bytes"] += self.model.cfg.n_layers * self.model.cfg.n_heads * seq_len * seq_len * 4
+
+            shard.append({"values": values.cpu(), "indices": None if indices is None else indices.cpu()})
+            index.append({
+                "id": task.get("id", i),
+                "task_class": task["task_class"],
+                "seq_len": seq_len,
+                "query_positions": query_idx,
+                "shard": len(shard_files),
+                "offset": len(shard) - 1,
+            })
+            if len(shard) == shard_size:
+                flush()
+
+        if shard:
+            flush()
+
+        torch.save({
+            "mode": self.mode,
+            "top_k": self.top_k,
+            "layers": self.layers,
+            "heads": self.heads,
+            "shards": shard_files,
+            "index": index,
+        }, os.path.join(output_dir, "meta.pt"))
+
+        stored = max(report["stored_bytes"], 1)
+        report["compression_ratio"] = report["full_fp32_bytes"] / stored
+        report["compression_ratio_vs_selection"] = report["selected_fp32_bytes"] / stored
+        report["mean_abs_error"] = report.pop("abs_error_sum") / max(report.pop("n_values"), 1)
+        print(f">>> Stored {stored / 2**20:.1f} MiB in {output_dir}: "
+              f"{report['compression_ratio']:.1f}x vs full fp32 patterns, "
+              f"{report['compression_ratio_vs_selection']:.1f}x vs selected fp32, "
+              f"max abs error {report['max_abs_error']:.2e}")
+        return report
+
+
+class AttentionPatternReader:
+    """Reads patterns written by AttentionPatternRecorder back as dense fp32 slices."""
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.meta = torch.load(os.path.join(output_dir, "meta.pt"))
+        self.index = self.meta["index"]
+        self._shard_id, self._shard = None, None
+
+    def __len__(self):
+        return len(self.index)
+
+    def _load(self, shard_id):
+        # keep one shard in memory; items are usually read in order
+        if shard_id != self._shard_id:
+            path = os.path.join(self.output_dir, self.meta["shards"][shard_id])
+            self._shard, self._shard_id = torch.load(path), shard_id
+        return self._shard
+
+    def item(self, idx):
+        """Metadata of item idx (id, task_class, seq_len, query_positions)."""
+        return self.index[idx]
+
+    def items_for_class(self, task_class):
+        return [i for i, entry in enumerate(self.index) if entry["task_class"] == task_class]
+
+    def dense(self, idx, layer=None, head=None):
+        """
+        Dense fp32 pattern for item idx: [layers, heads, queries, keys], narrowed to a single
+        layer / head when given (actual model layer / head numbers, not positions in the selection).
+        Rows are the stored query positions, see item(idx)["query_positions"].
+        """
+        entry = self.index[idx]
+        record = self._load(entry["shard"])[entry["offset"]]
+        values, indices = record["values"], record["indices"]
+
+        layer_sel = slice(None) if layer is None else self.meta["layers"].index(layer)
+        head_sel = slice(None) if head is None else self.meta["heads"].index(head)
+        values = values[layer_sel, head_sel]
+
+        if indices is None:
+            return values.float()
+
+        indices = indices[layer_sel, head_sel].long()
+        shape = values.shape[:-1] + (entry["seq_len"],)
+        return torch.zeros(shape).scatter_(-1, indices, values.float())
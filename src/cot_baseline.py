@@ -1,11 +1,14 @@
-import re
 import torch
 import json
 from tqdm import tqdm
 from transformer_lens import HookedTransformer
 
+from decoding import greedy_generate, batched_greedy_generate, speculative_generate, left_pad_prompts
+from answer_extraction import StreamingAnswerExtractor, is_correct_answer
+from metrics import MultiPatternMatcher
+
 class CoTBaselineRunner:
-    def __init__(self, model, model_name, device="cuda"):
+    def __init__(self, model, model_name, device="cuda", draft_model=None, num_draft_tokens=4, speedup_sample=3):
         print(f">> Loading {model_name}...")
         # Loading in fp16 to save memory as requested
         self.model = model
@@ -13,121 +16,192 @@ class CoTBaselineRunner:
         self.tokenizer = self.model.tokenizer
         self.stop_tokens = ["\n\n", "Q:", "Question:", "###"]
 
-    def _extract_answer(self, full_text):
+        # Optional speculative decoding: small draft model with the SAME tokenizer
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.speedup_sample = speedup_sample  # prompts also decoded target-only to measure speedup
+        if draft_model is not None and draft_model.cfg.d_vocab != model.cfg.d_vocab:
+            raise ValueError(
+                f"Draft model vocab ({draft_model.cfg.d_vocab}) does not match target vocab ({model.cfg.d_vocab})"
+            )
+        self._reset_spec_stats()
+
+    def _reset_spec_stats(self):
+        self.spec_stats = {
+            "proposed": 0, "accepted": 0, "new_tokens": 0, "target_forward_passes": 0,
+            "spec_seconds": 0.0, "target_only_seconds": 0.0, "sampled": 0, "mismatches": 0,
+        }
+
+    def _make_extractor(self, task_class):
+        return StreamingAnswerExtractor(task_class, self.tokenizer, stop_strings=self.stop_tokens)
+
+    def _generate_speculative(self, prompt, task_class, max_new_tokens=100):
+        """Speculative greedy decoding of one prompt; accumulates acceptance / speedup stats."""
+        tokens = self.model.to_tokens(prompt, prepend_bos=True)
+        eos_token_id = self.tokenizer.eos_token_id if self.tokenizer is not None else None
+        extractor = self._make_extractor(task_class)
+        new_tokens, stats = speculative_generate(
+            self.model, self.draft_model, tokens,
+            max_new_tokens=max_new_tokens,
+            num_draft_tokens=self.num_draft_tokens,
+            eos_token_id=eos_token_id,
+            stop_fn=lambda row, tok: extractor.feed_token(tok)
+        )
+        for key in ["proposed", "accepted", "new_tokens", "target_forward_passes"]:
+            self.spec_stats[key] += stats[key]
+
+        # On a small sample, also decode target-only to measure real speedup and check equality
+        if self.spec_stats["sampled"] < self.speedup_sample:
+            ref_extractor = self._make_extractor(task_class)
+            reference, ref_stats = greedy_generate(
+                self.model, tokens,
+                max_new_tokens=max_new_tokens,
+                eos_token_id=eos_token_id,
+                stop_fn=lambda row, tok: ref_extractor.feed_token(tok)
+            )
+            self.spec_stats["sampled"] += 1
+            self.spec_stats["spec_seconds"] += stats["seconds"]
+            self.spec_stats["target_only_seconds"] += ref_stats["seconds"]
+            if reference != new_tokens:
+                self.spec_stats["mismatches"] += 1
+                print(f"! ----- Speculative output differs from target-only output for prompt {prompt[-80:]!r}")
+
+        return extractor
+
+    def _log_spec_stats(self):
+        s = self.spec_stats
+        acceptance = s["accepted"] / s["proposed"] if s["proposed"] else 0.0
+        tokens_per_pass = s["new_tokens"] / s["target_forward_passes"] if s["target_forward_passes"] else 0.0
+        speedup = s["target_only_seconds"] / s["spec_seconds"] if s["spec_seconds"] else float("nan")
+        print(f">> Speculative decoding: acceptance rate {acceptance:.1%}, "
+              f"{tokens_per_pass:.2f} tokens per target pass, "
+              f"measured speedup {speedup:.2f}x over {s['sampled']} prompts "
+              f"({s['mismatches']} mismatches vs target-only)")
+
+    def _generate(self, prompts, task_classes, max_new_tokens=100):
         """
-        ########## OLD METHOD ##########
-        Attempts to isolate the final numeric/boolean answer from the text.
-        Splits by 'Answer:' or looks for the last number.
+        Greedy-decodes a batch of prompts with one streaming extractor per prompt.
+        Each row stops as soon as its extractor has a final answer (or hits a stop token);
+        returns the extractors, which hold the generated text and the answer.
         """
-        # 1. Try splitting by explicit marker
-        if "A:" in full_text:
-            after_marker = full_text.split("A:")[-1].strip()
-            # Take the first token/word after the marker
-            return after_marker.split()[0].replace(".", "")
-        
-        # 2. Fallback: Heuristic cleanup
-        # This is messy for base models; we'll refine based on your results
-        return "PARSE_ERROR"
-    
-    def _extract_numeric(self, text):
-        """Extracts the last number found in the text."""
-        # Look for explicit "Answer: X" first
-        match = re.search(r"(?:answer|result) is\s*(\-?\d+)", text, re.IGNORECASE)
-        if match: return match.group(1)
-        
-        # Fallback: Find all integers, return the last one
-        numbers = re.findall(r"\-?\d+", text)
-        if numbers: return numbers[-1]
-        return "PARSE_ERROR"
-
-    def _extract_boolean(self, text):
-        """Extracts True/False for Parity PAT task"""
-        # Normalize to lowercase for easy searching
-        lower_text = text.lower()
-        
-        # Check for explicit final statements first
-        if "answer is true" in lower_text or "result is true" in lower_text:
-            return "True"
-        if "answer is false" in lower_text or "result is false" in lower_text:
-            return "False"
-            
-        # Fallback: Check for the words appearing at the very end
-        # We look at the last 10 words generated
-        last_chunk = lower_text.split()[-10:] if len(lower_text.split()) > 10 else lower_text.split()
-        if "true" in last_chunk: return "True"
-        if "false" in last_chunk: return "False"
-        
-        return "PARSE_ERROR"
-    
+        if self.draft_model is not None:
+            return [self._generate_speculative(p, c, max_new_tokens) for p, c in zip(prompts, task_classes)]
+
+        extractors = [self._make_extractor(task_class) for task_class in task_classes]
+        eos_token_id = self.tokenizer.eos_token_id
+        stop_fn = lambda row, tok: extractors[row].feed_token(tok)
+
+        if len(prompts) == 1:
+            tokens = self.model.to_tokens(prompts[0], prepend_bos=True)
+            greedy_generate(self.model, tokens, max_new_tokens=max_new_tokens, eos_token_id=eos_token_id, stop_fn=stop_fn)
+            return extractors
+
+        # Left-pad so every prompt ends at the same position and new tokens line up
+        tokens, attention_mask = left_pad_prompts(self.model, prompts)
+        batched_greedy_generate(
+            self.model, tokens,
+            attention_mask=attention_mask,
+            max_new_tokens=max_new_tokens,
+            eos_token_id=eos_token_id,
+            stop_fn=stop_fn
+        )
+        return extractors
+
+    def generate_completions(self, dataset, batch_size=1, max_new_tokens=100):
+        """
+        Generation only, no scoring (used by the incremental pipeline).
+        :return: list[dict] with the CoT text and the answer committed during decoding (or None)
+        """
+        completions = []
+        for start in tqdm(range(0, len(dataset), batch_size)):
+            batch = dataset[start:start + batch_size]
+            extractors = self._generate(
+                [task['clean']['prompt'] for task in batch],
+                [task.get('task_class', 'unknown') for task in batch],
+                max_new_tokens=max_new_tokens
+            )
+            for task, extractor in zip(batch, extractors):
+                completions.append({
+                    "id": task.get("id", "unknown"),
+                    "task_class": task.get("task_class", "unknown"),
+                    "generated_cot": extractor.text,
+                    "early_answer": extractor.answer,
+                })
+        return completions
+
+    def run_baseline(self, dataset, output_file="baseline_results.jsonl", debug_limit=5, batch_size=1):
+        print(f">> Starting Baseline Run on {len(dataset)} tasks (batch size {batch_size})...")
+        self._reset_spec_stats()
 
-    # TODO: update run_baseline loop to separate answer by task type
-    def run_baseline(self, dataset, output_file="baseline_results.jsonl", debug_limit=5):
-        print(f">> Starting Baseline Run on {len(dataset)} tasks...")
-        
         # Track errors just for the print limit
         error_count = 0
-        
-        for task in tqdm(dataset):
-            prompt = task['clean']['prompt']
-            ground_truth = task['clean']['answer']
-            
+
+        batches = [dataset[i:i + batch_size] for i in range(0, len(dataset), batch_size)]
+        for batch in tqdm(batches):
             # --- GENERATION ---
-            output = self.model.generate(
-                prompt, 
-                max_new_tokens=100, 
-                temperature=0,
-                top_k=1,
-                prepend_bos=True,
-                verbose=False
+            extractors = self._generate(
+                [task['clean']['prompt'] for task in batch],
+                [task.get('task_class', 'unknown') for task in batch]
             )
-            
-            # --- CLEANING ---
-            generated_only = output[len(prompt):]
-            
-            # Stop token logic
-            for stop_tok in self.stop_tokens:
-                if stop_tok in generated_only:
-                    generated_only = generated_only.split(stop_tok)[0]
-            
-            # --- EXTRACTION ---
-            predicted_ans = self._extract_answer(generated_only)
-            
-            # --- DEBUGGING BLOCK (The Solution) ---
-            if predicted_ans == "PARSE_ERROR":
-                error_count += 1
-                if error_count <= debug_limit:
-                    print(f"\n[DEBUG FAILURE #{error_count}]")
-                    print(f"EXPECTED: {ground_truth}")
-                    print(f"MODEL OUTPUT (First 200 chars): {generated_only[:200]!r}...") 
-                    print("-" * 30)
-
-            # --- SCORING ---
-            is_correct = (ground_truth.strip().lower() in predicted_ans.lower())
-            
-            result_entry = {
-                "id": task.get("id", "unknown"),
-                "prompt": prompt, # Warning: Prompts are large. If low disk space, remove this.
-                "generated_cot": generated_only,
-                "predicted_answer": predicted_ans,
-                "ground_truth": ground_truth,
-                "is_correct": is_correct
-            }
-            
-            # --- STREAM TO DISK
-            # We append immediately and don't keep result_entry in RAM
-            with open(output_file, "a") as f:
-                f.write(json.dumps(result_entry) + "\n")
-            
-            # Force Python to clear the large string variables immediately
-            del output, generated_only, result_entry
+
+            for task, extractor in zip(batch, extractors):
+                prompt = task['clean']['prompt']
+                ground_truth = task['clean']['answer']
+
+                # --- CLEANING ---
+                # extractor text is already cut at the first stop token
+                generated_only = extractor.text
+
+                # --- EXTRACTION (dispatched on task class) ---
+                predicted_ans = extractor.result()
+
+                # --- DEBUGGING BLOCK (The Solution) ---
+                if predicted_ans == "PARSE_ERROR":
+                    error_count += 1
+                    if error_count <= debug_limit:
+                        print(f"\n[DEBUG FAILURE #{error_count}]")
+                        print(f"EXPECTED: {ground_truth}")
+                        print(f"MODEL OUTPUT (First 200 chars): {generated_only[:200]!r}...") 
+                        print("-" * 30)
+
+                # --- SCORING ---
+                is_correct = is_correct_answer(predicted_ans, ground_truth)
+
+                result_entry = {
+                    "id": task.get("id", "unknown"),
+                    "model_name": self.model_name,
+                    "task_class": task.get("task_class", "unknown"),
+                    "prompt": prompt, # Warning: Prompts are large. If low disk space, remove this.
+                    "generated_cot": generated_only,
+                    "predicted_answer": predicted_ans,
+                    "early_stop": extractor.answer is not None,
+                    "ground_truth": ground_truth,
+                    "is_correct": is_correct
+                }
+
+                # --- STREAM TO DISK
+                # We append immediately and don't keep result_entry in RAM
+                with open(output_file, "a") as f:
+                    f.write(json.dumps(result_entry) + "\n")
+
+                # Force Python to clear the large string variables immediately
+                del extractor, generated_only, result_entry
+
+            del extractors
+
+        if self.draft_model is not None:
+            self._log_spec_stats()
 
         return None # Don't return the huge list
     
+    @staticmethod
     def check_compliance_and_accuracy(grounded_results, required_components):
         """
         grounded_results: List of dicts from the Grounded CoT run.
         required_components: The list of IDs we asked the model to cite (e.g., ["Head 5.1", "L5H1"]).
+        For large results files / per-task breakdowns with CIs, use metrics.StreamingMetrics instead.
         """
+        matcher = MultiPatternMatcher(required_components)
         
         total = len(grounded_results)
         correct_answers = 0
@@ -142,7 +216,7 @@ class CoTBaselineRunner:
             # 2. Check Instruction Compliance (Did it cite the heads?)
             # We check if ALL required component tags appear in the generated CoT
             explanation = res['generated_cot']
-            is_compliant = all(comp_id in explanation for comp_id in required_components)
+            is_compliant = matcher.matches_all(explanation)
             
             if is_compliant:
                 compliant_explanations += 1
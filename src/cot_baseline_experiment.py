@@ -1,13 +1,16 @@
 import json
 import random
 import torch
-import gc
 from transformer_lens import HookedTransformer
 from tqdm import tqdm
 
-from setup import loadModel
 from task_generation import *
-from cot_baseline import CoTBaselineRunner
+from scheduler import MemoryBudgetScheduler, detect_memory_budget
+from cpu_profile import CPUProfile
+from pipeline import (
+    build_experiment_pipeline, TASK_CLASSES, model_short_name,
+    completions_stage, scores_stage, patching_stage, tokenization_stage,
+)
 from setup import *
 
 
@@ -15,93 +18,110 @@ from setup import *
 # TODO: lightweight error checking; update test scripts?
 # TODO: setup logs for experiment runs (initialization of models, generator, exemplars, datasets)?
 
-def clearMemory():
-    """Helper to aggressively free GPU memory between model loads."""
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
-    gc.collect()
-
-
 if __name__ == "__main__":
-  clearMemory()
+  clear_memory()
   phi_name = "microsoft/phi-1_5"
   llama_name = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
   gemma_name = "gemma-2-2b"
   qwen_name = "Qwen/Qwen1.5-1.8B"
+  device = "cuda" if torch.cuda.is_available() else "cpu"
+  # CPU-only nodes: bf16/fp32 + thread settings (+ optional compile / int8), gated against fp32 logits
+  cpu_profile = CPUProfile(compile=False, quantize_int8=False) if device == "cpu" else None
+  dtype = cpu_profile.dtype if cpu_profile is not None else torch.float16
   
-  # ===== SEQUENTIAL TESTING LOOP to save on memory ===== #
-  # --- initialization 
-  gen = MechanisticTaskGenerator(seed=42)
-  dataset = generateDataset(gen, 50)
-  exemplars = generateExemplars(generator=gen, num_exemplars=8)
-  
-  print(f"--- FROM EXEMPLARS:")
-  if len(exemplars) > 0:
-    print(json.dumps(exemplars, indent=4))
-  else:
-    print("nOTHING IN EXEMPLARS ????????????")
-  print("\n")
-
-  # [phi_name, llama_name, gemma_name, qwen_name]
-  for model_name in [phi_name]:
-    print(f"\n{'='*20}\nSTARTING MODEL: {model_name}\n{'='*20}\n")
+  model_names = [phi_name]  # [phi_name, llama_name, gemma_name, qwen_name]
+
+  # ===== INCREMENTAL PIPELINE: only stale stages are recomputed ===== #
+  # dataset -> exemplars -> prompts -> tokenization -> completions -> extractions -> scores -> metrics (+ patching)
+  pipeline = build_experiment_pipeline(
+      model_names,
+      examples_per_task=50,
+      num_exemplars=8,
+      seed=42,
+      dtype=str(dtype).replace("torch.", ""),
+      quantize_int8=cpu_profile is not None and cpu_profile.quantize_int8,
+      compile=cpu_profile is not None and cpu_profile.compile
+  )
+  prompts = pipeline.run(["prompts"])["prompts"]
+
+  print(f"\n{'-'*20}\nsample formatted item:\n{'-'*20}")
+  print(json.dumps(prompts[0], indent=4))
+
+  # --- plan only the (model, task_class) jobs whose generation / patching is stale
+  # the CPU profile loads fp32 weights (for its reference logits) before converting to dtype,
+  # and int8 adds quantized copies next to the fp weights
+  scheduler = MemoryBudgetScheduler(
+      budget_bytes=detect_memory_budget(device),
+      dtype=dtype,
+      load_dtype=torch.float32 if cpu_profile is not None else None,
+      int8_weights=cpu_profile is not None and cpu_profile.quantize_int8
+  )
+  jobs = []
+  for model_name in model_names:
+    job_stages = {
+        task_class: [completions_stage(model_name, task_class), patching_stage(model_name, task_class)]
+        for task_class in TASK_CLASSES
+    }
+    if not any(pipeline.is_stale(stage) for stages in job_stages.values() for stage in stages):
+      print(f">> {model_name}: generation and patching up to date, model not loaded")
+      continue
     try:
-      # --- load models
-      model = HookedTransformer.from_pretrained(
-          model_name, 
-          device="cuda",  # loads to GPU if available, otherwise CPU
-          dtype=torch.float16,  # save on memory
-          fold_ln=False
-      ) 
-      print(f"{'-'*10} Successfully loaded {model_name}\n")
-
-      # --- initialize CoT runner
-      runner = CoTBaselineRunner(model=model, model_name=model_name, device="cuda")
-
-      # --- run dataset
-      formatted_dataset = []
-
-      print(f"\n{'-'*20}\nsample from global dataset:\n{'-'*20}")
-      print(json.dumps(dataset[0], indent=4))
-
-      # print(json.dumps(dataset[1], indent=4))
-      for item in dataset[:3]:
-
-
-        print(f"\n---- CURRENT ITEM:\n{json.dumps(item, indent=4)}\n")
-        full_prompt = buildPrompt(task_item=item, exemplars=exemplars)
-        print(f"\n---- FULL PROMPT:\n{full_prompt}\n")
-
-
-        formatted_item = {
-            "task_class": item["task_class"],
-            "clean": {
-              "prompt": full_prompt, # REPLACES raw prompt with Few-Shot Prompt
-              "answer": item['clean']['answer']
-          }
-        }
-
-
-        print(f"\n{'-'*20}\nFORMATTED ITEM:")
-        print(json.dumps(formatted_item, indent=4))
-        formatted_dataset.append(formatted_item)
-
-      # # --- outputs
-      output_filename = f"baseline_results_{model_name.split("/")[1]}.jsonl"
-      runner.run_baseline(formatted_dataset, output_file=output_filename)
-      print(f">>> Finished {model_name}. Results in {output_filename}")
-
-      # --- cleanup
-      del model
-      del runner
-      clearMemory()
-      print(">>> Memory cleared")
-
+      scheduler.add_model(model_name)
+      lengths = pipeline.run([tokenization_stage(model_name)])[tokenization_stage(model_name)]
     except Exception as e:
-        print(f"! ----- Failed: {e}\n")
-        clearMemory()
-
+      print(f"! ----- Failed to fetch config / tokenizer for {model_name}: {e}\n")
+      continue
+    for task_class, stages in job_stages.items():
+      if any(pipeline.is_stale(stage) for stage in stages):
+        jobs.append({
+            "model_name": model_name,
+            "task_class": task_class,
+            "prompt_lengths": [lengths[item["id"]] for item in prompts if item["task_class"] == task_class],
+            "stages": stages,
+        })
+
+  plan = scheduler.plan(jobs)
+  scheduler.describe(plan)
+
+  def load_model(model_name):
+    print(f"\n{'='*20}\nSTARTING MODEL: {model_name}\n{'='*20}\n")
+    if cpu_profile is not None:
+      return cpu_profile.load_model(model_name, generator=MechanisticTaskGenerator())
+    return HookedTransformer.from_pretrained(
+        model_name,
+        device=device,
+        dtype=torch.float16,  # save on memory
+        fold_ln=False
+    )
+
+  def run_job(model, job, batch_size):
+    pipeline.run(job["stages"], runtime={"model": model, "batch_size": batch_size})
+    pipeline.forget(job["stages"])
+    print(f">>> Finished {job['model_name']} / {job['task_class']}")
+
+  reports = scheduler.run(plan, load_model=load_model, run_job=run_job)
+  if reports:
+    with open("memory_report.json", "w") as f:
+      json.dump(reports, f, indent=4)
+
+  # --- extraction / scoring / metrics never need a model
+  for model_name in model_names:
+    output_filename = f"baseline_results_{model_short_name(model_name)}.jsonl"
+    try:
+      scores = pipeline.run([scores_stage(model_name, c) for c in TASK_CLASSES])
+    except RuntimeError as e:
+      print(f"! ----- No results for {model_name}: {e}\n")
+      continue
+    with open(output_filename, "w") as f:
+      for rows in scores.values():
+        for row in rows:
+          f.write(json.dumps(row) + "\n")
+    print(f">>> Results for {model_name} in {output_filename}")
+
+  try:
+    print(json.dumps(pipeline.run(["metrics"])["metrics"], indent=4))
+  except RuntimeError as e:
+    print(f"! ----- Metrics incomplete: {e}\n")
 
 
 
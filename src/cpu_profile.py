@@ -0,0 +1,200 @@
+import os
+import torch
+import torch.nn as nn
+from transformer_lens import HookedTransformer
+
+
+def _cpu_flags():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+def cpu_supports_bf16():
+    """bf16 is only faster than fp32 on CPUs with native bf16 matmuls (AVX512-BF16 / AMX)."""
+    flags = _cpu_flags()
+    return bool(flags & {"avx512_bf16", "amx_bf16"}) and torch.backends.mkldnn.is_available()
+
+def _available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# -------------------------------------------------------------------------
+# Weight-only int8 matmuls
+# -------------------------------------------------------------------------
+class Int8WeightOnlyLinear(nn.Module):
+    """
+    y = x @ W + b with W stored as int8 + per-output-channel scales.
+    Uses torch's CPU weight-only int8 kernel, activations stay in bf16 / fp32.
+    :param weight: [d_in, d_out] (TransformerLens layout)
+    """
+    def __init__(self, weight, bias=None):
+        super().__init__()
+        w = weight.detach().float().t().contiguous()  # [d_out, d_in]
+        scales = w.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+        self.register_buffer("w_int8", torch.round(w / scales[:, None]).clamp(-128, 127).to(torch.int8))
+        self.register_buffer("scales", scales.to(weight.dtype))
+        self.register_buffer("bias", None if bias is None else bias.detach().clone())
+
+    def forward(self, x):
+        shape = x.shape
+        out = torch._weight_int8pack_mm(x.reshape(-1, shape[-1]).contiguous(), self.w_int8, self.scales)
+        out = out.reshape(*shape[:-1], -1)
+        return out if self.bias is None else out + self.bias
+
+
+def _quantize_mlp(mlp):
+    """Swaps the MLP's matmuls for int8 ones; hook points are kept so patching / probing still works."""
+    mlp.int8_in = Int8WeightOnlyLinear(mlp.W_in, mlp.b_in if not mlp.cfg.gated_mlp else None)
+    mlp.int8_out = Int8WeightOnlyLinear(mlp.W_out, mlp.b_out)
+
+    if mlp.cfg.gated_mlp:
+        mlp.int8_gate = Int8WeightOnlyLinear(mlp.W_gate)
+
+        def forward(x):
+            pre_act = mlp.hook_pre(mlp.int8_gate(x))
+            pre_linear = mlp.hook_pre_linear(mlp.int8_in(x))
+            post_act = mlp.hook_post(mlp.act_fn(pre_act) * pre_linear + mlp.b_in)
+            return mlp.int8_out(post_act)
+    else:
+        def forward(x):
+            pre_act = mlp.hook_pre(mlp.int8_in(x))
+            post_act = mlp.hook_post(mlp.act_fn(pre_act))
+            return mlp.int8_out(post_act)
+
+    mlp.forward = forward
+
+def _quantize_unembed(unembed):
+    unembed.int8 = Int8WeightOnlyLinear(unembed.W_U, unembed.b_U)
+    unembed.forward = unembed.int8
+
+
+# -------------------------------------------------------------------------
+# Profile
+# -------------------------------------------------------------------------
+class CPUProfile:
+    """
+    Execution profile for CPU-only nodes.
+    - dtype: "auto" picks bf16 when the CPU has native bf16 matmuls, else fp32 (never fp16 on CPU)
+    - num_threads / interop_threads: default to the cores this process may use
+    - compile: torch.compile every transformer block (hooks still fire, at the cost of graph breaks)
+    - quantize_int8: weight-only int8 for MLP and unembedding matmuls; fp weights are kept so
+      code reading model.W_* (e.g. the logit lens) still works, so this speeds up matmuls but
+      INCREASES memory (the int8 copies come on top of the fp weights; plan with
+      MemoryBudgetScheduler(int8_weights=True)).
+      Attention projections stay in floating point: they are per-head einsums feeding hook_q/k/v/z,
+      whose forward differs across attention types (rotary, grouped kv) and which head patching
+      reads and writes; MLP (2 * d_model * d_mlp per layer) and unembedding hold most of the weights.
+    Memory: load_model materializes the model in fp32 before converting it, so plan for the fp32
+    load peak (MemoryBudgetScheduler(load_dtype=torch.float32)), not for the profile's dtype.
+    """
+    def __init__(self, dtype="auto", num_threads=None, interop_threads=None, compile=False, quantize_int8=False):
+        if dtype == "auto":
+            dtype = torch.bfloat16 if cpu_supports_bf16() else torch.float32
+        if dtype == torch.float16:
+            raise ValueError("fp16 is emulated on CPU and much slower than fp32; use bf16 or fp32")
+        self.dtype = dtype
+        self.num_threads = num_threads or _available_cpus()
+        self.interop_threads = interop_threads or max(1, min(4, self.num_threads // 4))
+        self.compile = compile
+        self.quantize_int8 = quantize_int8
+
+    def describe(self):
+        return (f"dtype={str(self.dtype).replace('torch.', '')}, threads={self.num_threads}, "
+                f"interop={self.interop_threads}, compile={self.compile}, int8={self.quantize_int8}")
+
+    def configure_threads(self):
+        torch.set_num_threads(self.num_threads)
+        try:
+            torch.set_num_interop_threads(self.interop_threads)
+        except RuntimeError:
+            # can only be set once, before any inter-op parallel work has started
+            print(f"! ----- Could not set interop threads (already {torch.get_num_interop_threads()})")
+
+    def apply(self, model):
+        """Converts an fp32 CPU model in place according to the profile and returns it."""
+        model.to(self.dtype)
+        model.eval()
+
+        if self.quantize_int8:
+            if not hasattr(torch, "_weight_int8pack_mm"):
+                print("! ----- This torch build has no weight-only int8 kernel, skipping quantization")
+            else:
+                for block in model.blocks:
+                    # SoLU-style MLPs have an extra LN on the hidden layer; leave those alone
+                    if not model.cfg.attn_only and not hasattr(block.mlp, "ln"):
+                        _quantize_mlp(block.mlp)
+                _quantize_unembed(model.unembed)
+
+        if self.compile:
+            for block in model.blocks:
+                block.forward = torch.compile(block.forward, dynamic=True)
+
+        return model
+
+    def load_model(self, model_name, generator=None, n_gate_tasks=8, **gate_kwargs):
+        """
+        Loads model_name on CPU in fp32, records reference logits on generator tasks, applies the
+        profile and runs the accuracy gate before returning the model.
+        Peak memory is the fp32 model plus the reference logits, even when the profile runs in bf16:
+        the reference has to come from the original fp32 weights.
+        """
+        self.configure_threads()
+        print(f">> Loading {model_name} on CPU ({self.describe()})...")
+        model = HookedTransformer.from_pretrained(model_name, device="cpu", dtype=torch.float32, fold_ln=False)
+
+        prompts = sample_gate_prompts(generator, n_gate_tasks) if generator is not None else []
+        reference = reference_logits(model, prompts)
+        self.apply(model)
+        if prompts:
+            accuracy_gate(model, prompts, reference, **gate_kwargs)
+        return model
+
+
+# -------------------------------------------------------------------------
+# Accuracy gate
+# -------------------------------------------------------------------------
+def sample_gate_prompts(generator, n_tasks=8):
+    """A few clean prompts from every task type."""
+    makers = [generator.generate_linear_pair, generator.generate_cblg_pair,
+              generator.generate_multiway_pair, generator.generate_parity_pat_pair]
+    per_task = max(1, n_tasks // len(makers))
+    return [make()['clean']['prompt'] for make in makers for _ in range(per_task)]
+
+@torch.no_grad()
+def reference_logits(model, prompts):
+    """fp32 logits at every position for each prompt (computed before the profile is applied)."""
+    return [model(prompt).float()[0] for prompt in prompts]
+
+@torch.no_grad()
+def accuracy_gate(model, prompts, reference, min_top1_agreement=0.95, max_rel_error=0.25):
+    """
+    Compares the profiled model's logits with the fp32 reference on every position.
+    - top-1 agreement: fraction of positions whose argmax token is unchanged
+    - relative error: max |logit diff| / std of the reference logits at that position
+    Raises RuntimeError if the profile changes the model too much to trust a sweep.
+    """
+    agree, total, worst = 0, 0, 0.0
+    for prompt, ref in zip(prompts, reference):
+        logits = model(prompt).float()[0]
+        agree += (logits.argmax(-1) == ref.argmax(-1)).sum().item()
+        total += ref.shape[0]
+        rel = (logits - ref).abs().amax(-1) / ref.std(-1).clamp(min=1e-6)
+        worst = max(worst, rel.max().item())
+
+    report = {"top1_agreement": agree / total, "max_rel_error": worst, "positions": total}
+    print(f">> Accuracy gate: top-1 agreement {report['top1_agreement']:.2%}, "
+          f"max relative logit error {worst:.3f} over {total} positions")
+    if report["top1_agreement"] < min_top1_agreement or worst > max_rel_error:
+        raise RuntimeError(
+            f"CPU profile failed accuracy gate (agreement {report['top1_agreement']:.2%} < {min_top1_agreement:.0%} "
+            f"or relative error {worst:.3f} > {max_rel_error})"
+        )
+    return report
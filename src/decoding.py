@@ -0,0 +1,235 @@
+import time
+import torch
+from transformer_lens import utils
+from transformer_lens.past_key_value_caching import HookedTransformerKeyValueCache
+
+
+# -------------------------------------------------------------------------
+# Helpers: KV cache bookkeeping
+# -------------------------------------------------------------------------
+def _init_cache(model, batch_size=1):
+    return HookedTransformerKeyValueCache.init_cache(model.cfg, model.cfg.device, batch_size)
+
+def _cache_len(cache):
+    return cache.entries[0].past_keys.shape[1]
+
+def _truncate_cache(cache, length):
+    """Drops cached keys/values past `length` (used to roll back rejected draft tokens)."""
+    for entry in cache.entries:
+        entry.past_keys = entry.past_keys[:, :length]
+        entry.past_values = entry.past_values[:, :length]
+    if getattr(cache, "previous_attention_mask", None) is not None:
+        cache.previous_attention_mask = cache.previous_attention_mask[:, :length]
+
+def _forward(model, token_list, cache):
+    """Runs token_list through the model on top of the cache, returns logits [1, len, d_vocab]."""
+    tokens = torch.tensor([token_list], device=model.cfg.device)
+    # explicit mask: we never feed padding, and an EOS mid-window must not be masked out
+    return model(tokens, past_kv_cache=cache, attention_mask=torch.ones_like(tokens))
+
+def _sync_cache(model, cache, seq):
+    """Makes the cache hold exactly seq[:-1]; the last token of seq is fed on the next step."""
+    cached, needed = _cache_len(cache), len(seq) - 1
+    if cached > needed:
+        _truncate_cache(cache, needed)
+        return 0
+    if cached < needed:
+        _forward(model, seq[cached:needed], cache)
+        return 1
+    return 0
+
+
+# -------------------------------------------------------------------------
+# Helpers: batching
+# -------------------------------------------------------------------------
+def left_pad_prompts(model, prompts, prepend_bos=True):
+    """
+    Left-pads a batch of prompts so they all end at the same position.
+    The mask is built from each prompt's own length (pad can equal BOS, so not from token ids)
+    and must be passed to the model as attention_mask: TransformerLens only masks left padding
+    (and shifts positions) by itself when the tokenizer's padding_side is "left".
+    :return: tokens [batch, pos], attention_mask [batch, pos] (0 on padding)
+    """
+    rows = [model.to_tokens(prompt, prepend_bos=prepend_bos)[0] for prompt in prompts]
+    width = max(len(row) for row in rows)
+    pad_token_id = getattr(model.tokenizer, "pad_token_id", None)
+    tokens = torch.full((len(rows), width), pad_token_id or 0, dtype=rows[0].dtype, device=rows[0].device)
+    attention_mask = torch.zeros_like(tokens)
+    for i, row in enumerate(rows):
+        tokens[i, width - len(row):] = row
+        attention_mask[i, width - len(row):] = 1
+    return tokens, attention_mask
+
+@torch.no_grad()
+def gather_resid(model, prompts, layers, positions):
+    """
+    resid_post of a left-padded batch at the given layers and positions, in one forward pass
+    without the unembedding.
+    :param positions: offsets from the end of the prompt; with left padding they index the same
+                      prompt positions in every row
+    :return: [batch, layers, positions, d_model] on the model's device
+    """
+    stored = {}
+
+    def store_hook(act, hook):
+        stored[hook.layer()] = act[:, positions].detach()
+
+    tokens, attention_mask = left_pad_prompts(model, prompts)
+    model.run_with_hooks(
+        tokens,
+        return_type=None,
+        attention_mask=attention_mask,
+        fwd_hooks=[(utils.get_act_name("resid_post", layer), store_hook) for layer in layers],
+    )
+    return torch.stack([stored[layer] for layer in layers], dim=1)
+
+
+# -------------------------------------------------------------------------
+# Greedy decoding
+# -------------------------------------------------------------------------
+@torch.no_grad()
+def greedy_generate(model, tokens, max_new_tokens=100, eos_token_id=None, stop_fn=None):
+    """
+    Target-only greedy decoding with a KV cache.
+    :param tokens: [1, pos] prompt tokens (BOS already prepended)
+    :param stop_fn: optional fn(row, token_id) -> bool, called on every new token; True stops decoding
+    :return: (list[int] of new tokens, stats dict)
+    """
+    start = time.time()
+    cache = _init_cache(model)
+    logits = _forward(model, tokens[0].tolist(), cache)
+    forward_passes = 1
+
+    generated = []
+    while len(generated) < max_new_tokens:
+        next_tok = logits[0, -1].argmax().item()
+        generated.append(next_tok)
+        stop = stop_fn is not None and stop_fn(0, next_tok)
+        if stop or next_tok == eos_token_id or len(generated) == max_new_tokens:
+            break
+        logits = _forward(model, [next_tok], cache)
+        forward_passes += 1
+
+    stats = {
+        "new_tokens": len(generated),
+        "target_forward_passes": forward_passes,
+        "seconds": time.time() - start,
+    }
+    return generated, stats
+
+
+@torch.no_grad()
+def batched_greedy_generate(model, tokens, attention_mask=None, max_new_tokens=100, eos_token_id=None, stop_fn=None):
+    """
+    Greedy decoding of a left-padded batch with a KV cache. A row is finished at EOS or when
+    stop_fn(row, token_id) returns True; decoding ends as soon as every row is finished.
+    :param tokens: [batch, pos] left-padded prompt tokens
+    :param attention_mask: [batch, pos], 0 on padding (default: no padding)
+    :return: (list[list[int]] of new tokens per row, stats dict)
+    """
+    start = time.time()
+    batch_size = tokens.shape[0]
+    if attention_mask is None:
+        attention_mask = torch.ones_like(tokens)
+
+    cache = _init_cache(model, batch_size)
+    logits = model(tokens, past_kv_cache=cache, attention_mask=attention_mask)
+    forward_passes = 1
+
+    generated = [[] for _ in range(batch_size)]
+    done = [False] * batch_size
+    for step in range(max_new_tokens):
+        next_tokens = logits[:, -1].argmax(dim=-1)
+        for row, tok in enumerate(next_tokens.tolist()):
+            if done[row]:
+                continue
+            generated[row].append(tok)
+            if tok == eos_token_id or (stop_fn is not None and stop_fn(row, tok)):
+                done[row] = True
+        if all(done) or step == max_new_tokens - 1:
+            break
+        # finished rows keep decoding so the batch stays rectangular; their tokens are dropped
+        step_tokens = next_tokens[:, None]
+        logits = model(step_tokens, past_kv_cache=cache, attention_mask=torch.ones_like(step_tokens))
+        forward_passes += 1
+
+    stats = {
+        "new_tokens": sum(len(row) for row in generated),
+        "target_forward_passes": forward_passes,
+        "seconds": time.time() - start,
+    }
+    return generated, stats
+
+
+@torch.no_grad()
+def speculative_generate(target, draft, tokens, max_new_tokens=100, num_draft_tokens=4, eos_token_id=None, stop_fn=None):
+    """
+    Greedy speculative decoding: the draft proposes `num_draft_tokens` tokens, the target
+    checks all of them in one forward pass and keeps the longest prefix it agrees with, plus
+    its own next token. Under greedy decoding the output equals greedy_generate(target, ...)
+    (up to floating point ties between near-equal logits).
+    Both models must share a tokenizer / vocabulary.
+    :param tokens: [1, pos] prompt tokens (BOS already prepended)
+    :param stop_fn: optional fn(row, token_id) -> bool, called on every committed token; True stops decoding
+    :return: (list[int] of new tokens, stats dict)
+    """
+    start = time.time()
+    target_cache, draft_cache = _init_cache(target), _init_cache(draft)
+    seq = tokens[0].tolist()
+    stats = {"proposed": 0, "accepted": 0, "target_forward_passes": 0, "draft_forward_passes": 0}
+
+    # Prefill everything except the last prompt token, which is the first "pending" token
+    if len(seq) > 1:
+        _forward(target, seq[:-1], target_cache)
+        _forward(draft, seq[:-1], draft_cache)
+        stats["target_forward_passes"] += 1
+        stats["draft_forward_passes"] += 1
+
+    generated = []
+    while len(generated) < max_new_tokens:
+        # leave room for the target's own token at the end of each round
+        k = min(num_draft_tokens, max_new_tokens - len(generated) - 1)
+
+        # --- 1. Draft proposes k tokens autoregressively
+        proposal = []
+        draft_input = [seq[-1]]
+        for _ in range(k):
+            logits = _forward(draft, draft_input, draft_cache)
+            stats["draft_forward_passes"] += 1
+            tok = logits[0, -1].argmax().item()
+            proposal.append(tok)
+            draft_input = [tok]
+            if tok == eos_token_id:
+                break
+
+        # --- 2. Target scores pending token + whole proposal in ONE pass
+        logits = _forward(target, [seq[-1]] + proposal, target_cache)
+        stats["target_forward_passes"] += 1
+        target_choice = logits[0].argmax(dim=-1).tolist()
+
+        # --- 3. Accept the agreeing prefix, then take the target's token
+        n_accepted = 0
+        while n_accepted < len(proposal) and proposal[n_accepted] == target_choice[n_accepted]:
+            n_accepted += 1
+        new_tokens = proposal[:n_accepted] + [target_choice[n_accepted]]
+        stats["proposed"] += len(proposal)
+        stats["accepted"] += n_accepted
+
+        stop = False
+        for i, tok in enumerate(new_tokens):
+            if tok == eos_token_id or (stop_fn is not None and stop_fn(0, tok)):
+                new_tokens, stop = new_tokens[:i + 1], True
+                break
+        seq.extend(new_tokens)
+        generated.extend(new_tokens)
+        if stop:
+            break
+
+        # --- 4. Roll both caches back (or forward) to the committed sequence
+        stats["target_forward_passes"] += _sync_cache(target, target_cache, seq)
+        stats["draft_forward_passes"] += _sync_cache(draft, draft_cache, seq)
+
+    stats["new_tokens"] = len(generated)
+    stats["acceptance_rate"] = stats["accepted"] / stats["proposed"] if stats["proposed"] else 0.0
+    stats["seconds"] = time.time() - start
+    return generated, stats
@@ -0,0 +1,115 @@
+import torch
+from tqdm import tqdm
+
+from decoding import gather_resid
+
+
+class LogitLensAnalyzer:
+    """
+    Batched logit lens over the dataset: for every item, how strongly (logit) and how highly
+    (rank among candidate answers) each layer's residual stream predicts the correct answer.
+    Only the candidate answer tokens are unembedded, never the full vocabulary.
+    Items whose answer is not a single token are skipped (their ids are reported): with
+    multi-token answers different answers share a first token and the rank means nothing.
+    """
+    def __init__(self, model, answer_prefix=" "):
+        self.model = model
+        # answers follow "Result:" / "A:", so their first token carries a leading space
+        self.answer_prefix = answer_prefix
+
+    def answer_token(self, answer):
+        """The answer's token, as it would be generated; None if the answer is not a single token."""
+        try:
+            return self.model.to_single_token(self.answer_prefix + answer)
+        except AssertionError:
+            return None
+
+    def _candidate_unembed(self, candidate_ids):
+        """W_U / b_U restricted to the candidate answer tokens: [d_model, C], [C]."""
+        idx = torch.tensor(candidate_ids, device=self.model.W_U.device)
+        return self.model.W_U[:, idx], self.model.b_U[idx]
+
+    @torch.no_grad()
+    def _decode_batch(self, prompts, answer_idx, layers, positions, W_U_c, b_U_c):
+        """
+        One forward pass for the batch, then all layers decoded with a single matmul.
+        :return: answer logit and rank, each [batch, layers, positions]
+        """
+        resid = gather_resid(self.model, prompts, layers, positions).transpose(0, 1)  # [L, B, P, d_model]
+        n_layers, batch, n_pos, d_model = resid.shape
+
+        # final LN + restricted unembed for every layer at once
+        normed = self.model.ln_final(resid.reshape(n_layers * batch, n_pos, d_model))
+        logits = normed.reshape(-1, d_model) @ W_U_c + b_U_c  # [L*B*P, C]
+        logits = logits.reshape(n_layers, batch, n_pos, -1)
+
+        gather_idx = answer_idx.view(1, batch, 1, 1).expand(n_layers, batch, n_pos, 1)
+        answer_logit = logits.gather(-1, gather_idx)  # [L, B, P, 1]
+        answer_rank = (logits > answer_logit).sum(dim=-1)  # 0 = top candidate
+
+        return answer_logit.squeeze(-1).permute(1, 0, 2).float().cpu(), answer_rank.permute(1, 0, 2).cpu()
+
+    def run(self, dataset, layers=None, positions=(-1,), batch_size=16, output_file=None):
+        """
+        :param dataset: list[dict] of generator items (uses task_class and the clean prompt/answer)
+        :param layers: layers whose resid_post is decoded (default: all)
+        :param positions: offsets from the end of the prompt (default: final token only)
+        :param output_file: optional path, results are written with torch.save
+        :return: {task_class: {"ids", "skipped_ids", "layers", "positions", "answer_logit", "answer_rank"}}
+                 arrays are [items x layers], or [items x layers x positions] if several positions
+        """
+        layers = list(range(self.model.cfg.n_layers)) if layers is None else list(layers)
+        positions = list(positions)
+
+        answer_tokens = [self.answer_token(task['clean']['answer']) for task in dataset]
+        skipped = {}
+        for i, (task, tok) in enumerate(zip(dataset, answer_tokens)):
+            if tok is None:
+                skipped.setdefault(task["task_class"], []).append(task.get("id", i))
+        kept = [i for i, tok in enumerate(answer_tokens) if tok is not None]
+        print(f">> Logit lens over {len(kept)} items, {len(layers)} layers, positions {positions} "
+              f"({len(dataset) - len(kept)} skipped: answer is not a single token)...")
+        if not kept:
+            return {}
+
+        # Candidate set = every distinct answer token in the dataset
+        candidate_ids = sorted({answer_tokens[i] for i in kept})
+        candidate_index = {tok: i for i, tok in enumerate(candidate_ids)}
+        W_U_c, b_U_c = self._candidate_unembed(candidate_ids)
+
+        by_class = {}
+        for start in tqdm(range(0, len(kept), batch_size)):
+            batch_idx = kept[start:start + batch_size]
+            answer_idx = torch.tensor([candidate_index[answer_tokens[i]] for i in batch_idx], device=W_U_c.device)
+            prompts = [dataset[i]['clean']['prompt'] for i in batch_idx]
+            logit, rank = self._decode_batch(prompts, answer_idx, layers, positions, W_U_c, b_U_c)
+
+            for row, i in enumerate(batch_idx):
+                task = dataset[i]
+                entry = by_class.setdefault(task["task_class"], {"ids": [], "answer_logit": [], "answer_rank": []})
+                entry["ids"].append(task.get("id", i))
+                entry["answer_logit"].append(logit[row])
+                entry["answer_rank"].append(rank[row])
+
+        results = {}
+        for task_class, entry in by_class.items():
+            answer_logit = torch.stack(entry["answer_logit"])
+            answer_rank = torch.stack(entry["answer_rank"])
+            if len(positions) == 1:
+                answer_logit, answer_rank = answer_logit[..., 0], answer_rank[..., 0]
+            results[task_class] = {
+                "ids": entry["ids"],
+                "skipped_ids": skipped.get(task_class, []),
+                "layers": layers,
+                "positions": positions,
+                "num_candidates": len(candidate_ids),
+                "answer_logit": answer_logit,
+                "answer_rank": answer_rank,
+            }
+            print(f"   {task_class}: {tuple(answer_logit.shape)}, {len(skipped.get(task_class, []))} skipped")
+
+        if output_file is not None:
+            torch.save(results, output_file)
+            print(f">>> Logit lens results in {output_file}")
+
+        return results
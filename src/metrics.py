@@ -0,0 +1,147 @@
+import os
+import re
+import json
+import torch
+
+METRIC_NAMES = ["task_accuracy", "compliance_rate", "usable_data_yield"]
+
+
+class MultiPatternMatcher:
+    """
+    Finds which of many literal patterns (e.g. component ids "L5H1", "Head 5.1") occur in a text
+    in a single regex pass, with the same semantics as `pattern in text` for each pattern.
+    """
+    def __init__(self, patterns):
+        self.patterns = list(dict.fromkeys(patterns))
+        self.all_bits = (1 << len(self.patterns)) - 1
+        # a match of p also implies every pattern that is a substring of p ("L5H10" -> "L5H1")
+        self._implied = {
+            p: sum(1 << i for i, q in enumerate(self.patterns) if q in p) for p in self.patterns
+        }
+        self._regex = None
+        if self.patterns:
+            # lookahead finds overlapping matches; longest alternatives first
+            alternation = "|".join(re.escape(p) for p in sorted(self.patterns, key=len, reverse=True))
+            self._regex = re.compile(f"(?=({alternation}))")
+
+    def match_mask(self, text):
+        """Bitmask of the patterns present in text (bit i = self.patterns[i])."""
+        mask = 0
+        if self._regex is None:
+            return mask
+        for match in self._regex.finditer(text):
+            mask |= self._implied[match.group(1)]
+            if mask == self.all_bits:
+                break
+        return mask
+
+    def matches_all(self, text):
+        return self.match_mask(text) == self.all_bits
+
+
+def _model_from_filename(path):
+    # baseline_results_{model}.jsonl -> model
+    name = os.path.splitext(os.path.basename(path))[0]
+    return name[len("baseline_results_"):] if name.startswith("baseline_results_") else name
+
+
+def iter_result_chunks(paths, chunk_size=4096):
+    """Streams jsonl results files as lists of at most chunk_size rows; never holds a whole file."""
+    if isinstance(paths, str):
+        paths = [paths]
+    chunk = []
+    for path in paths:
+        default_model = _model_from_filename(path)
+        with open(path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                row.setdefault("model_name", default_model)
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+
+class StreamingMetrics:
+    """
+    Accuracy / compliance / usable-data yield per (model, task_class), streamed in chunks.
+    Confidence intervals use the Poisson bootstrap: every row gets a Poisson(1) weight per
+    replicate, so replicates are accumulated on the fly and memory stays
+    O(groups x n_bootstrap) regardless of how many rows are read.
+    """
+    def __init__(self, required_components=(), n_bootstrap=1000, confidence=0.95, chunk_size=4096, seed=0):
+        self.matcher = MultiPatternMatcher(required_components)
+        self.n_bootstrap = n_bootstrap
+        self.confidence = confidence
+        self.chunk_size = chunk_size
+        self.generator = torch.Generator().manual_seed(seed)
+
+        self.groups = {}  # (model_name, task_class) -> row in the accumulators
+        # columns: [n, correct, compliant, valid]
+        self.counts = torch.zeros(0, 4, dtype=torch.float64)
+        self.boot = torch.zeros(0, 4, n_bootstrap, dtype=torch.float64)
+
+    def _group_ids(self, rows):
+        ids = []
+        for row in rows:
+            key = (row.get("model_name", "unknown"), row.get("task_class", "unknown"))
+            if key not in self.groups:
+                self.groups[key] = len(self.groups)
+            ids.append(self.groups[key])
+
+        n_new = len(self.groups) - self.counts.shape[0]
+        if n_new > 0:
+            self.counts = torch.cat([self.counts, torch.zeros(n_new, 4, dtype=torch.float64)])
+            self.boot = torch.cat([self.boot, torch.zeros(n_new, 4, self.n_bootstrap, dtype=torch.float64)])
+        return torch.tensor(ids, dtype=torch.long)
+
+    def update(self, rows):
+        """Adds one chunk of result rows (dicts as written by CoTBaselineRunner.run_baseline)."""
+        group_ids = self._group_ids(rows)
+        correct = torch.tensor([bool(row.get("is_correct")) for row in rows], dtype=torch.float64)
+        compliant = torch.tensor(
+            [self.matcher.matches_all(row.get("generated_cot", "")) for row in rows], dtype=torch.float64
+        )
+        stats = torch.stack([torch.ones_like(correct), correct, compliant, correct * compliant], dim=1)  # [n, 4]
+        self.counts.index_add_(0, group_ids, stats)
+
+        weights = torch.poisson(torch.ones(len(rows), self.n_bootstrap, dtype=torch.float64), generator=self.generator)
+        for j in range(stats.shape[1]):
+            self.boot[:, j].index_add_(0, group_ids, weights * stats[:, j:j + 1])
+
+    def consume(self, paths):
+        for chunk in iter_result_chunks(paths, self.chunk_size):
+            self.update(chunk)
+        return self
+
+    def summary(self):
+        """:return: list[dict], one row per (model, task_class) with rates and CI bounds"""
+        if not self.groups:
+            return []
+        n = self.counts[:, :1]
+        rates = self.counts[:, 1:] / n  # [G, 3]
+
+        boot_n = self.boot[:, :1]
+        # a replicate that gave a group zero total weight has no rate for it: skip it (NaN), don't count it as 0
+        boot_rates = torch.where(boot_n > 0, self.boot[:, 1:] / boot_n.clamp(min=1), float("nan"))  # [G, 3, B]
+        alpha = (1 - self.confidence) / 2
+        q = torch.tensor([alpha, 1 - alpha], dtype=torch.float64)
+        bounds = torch.nanquantile(boot_rates, q, dim=-1)  # [2, G, 3]
+
+        summary = []
+        for (model_name, task_class), g in sorted(self.groups.items()):
+            row = {"model_name": model_name, "task_class": task_class, "n": int(n[g, 0].item())}
+            for m, name in enumerate(METRIC_NAMES):
+                row[name] = rates[g, m].item()
+                row[f"{name}_ci"] = (bounds[0, g, m].item(), bounds[1, g, m].item())
+            summary.append(row)
+        return summary
+
+
+def compute_metrics(paths, required_components=(), **kwargs):
+    """Convenience wrapper: stream results files and return the per (model, task_class) summary."""
+    return StreamingMetrics(required_components, **kwargs).consume(paths).summary()
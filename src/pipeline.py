@@ -0,0 +1,303 @@
+import os
+import re
+import json
+import pickle
+import hashlib
+import inspect
+
+import decoding
+import scheduler
+import answer_extraction
+import metrics
+from task_generation import MechanisticTaskGenerator, patch_heads
+from setup import generateDataset, generateExemplars, buildPrompt
+from cot_baseline import CoTBaselineRunner
+from answer_extraction import extract_final, is_correct_answer
+from metrics import StreamingMetrics
+
+# bump to invalidate every stored artifact (e.g. after changing the artifact format)
+PIPELINE_VERSION = 1
+
+TASK_CLASSES = ["linear_symbolic", "CBLG", "multiway_branching", "Parity_PAT"]
+
+
+def code_fingerprint(objects):
+    """
+    Hash of the source code of the modules / functions / classes (and repr of other values) a stage
+    depends on. A function's source does not cover the module-level regexes, constants and helpers
+    it uses, so stages also list those objects (or whole modules).
+    """
+    h = hashlib.sha256()
+    for obj in objects:
+        if isinstance(obj, re.Pattern):
+            text = f"{obj.pattern}/{obj.flags}"
+        elif isinstance(obj, dict):
+            text = repr(sorted((str(k), code_fingerprint([v])) for k, v in obj.items()))
+        elif inspect.ismodule(obj) or inspect.isfunction(obj) or inspect.ismethod(obj) or inspect.isclass(obj):
+            text = inspect.getsource(obj)
+        else:
+            text = repr(obj)
+        h.update(text.encode())
+    return h.hexdigest()
+
+
+class Pipeline:
+    """
+    Stage graph with content-addressed artifacts.
+    Each stage's key hashes its parameters, the source of the code it depends on and the keys
+    of its inputs; an artifact is stored once per key, so a run only recomputes stages whose
+    key changed (and loads cached inputs only when something downstream needs recomputing).
+    Stage functions are called as fn(inputs, params, runtime):
+    - inputs: {dep_name: artifact}; deps may be given as {local_name: stage_name} to rename them
+    - params: JSON-able values that are part of the key
+    - runtime: objects that are NOT part of the key (loaded model, batch size, ...)
+    """
+    def __init__(self, cache_dir=".pipeline_cache"):
+        self.cache_dir = cache_dir
+        self.stages = {}
+        self._keys = {}
+        self._memory = {}
+
+    def add(self, name, fn, deps=(), params=None, code=()):
+        deps = dict(deps) if isinstance(deps, dict) else {dep: dep for dep in deps}
+        for dep in deps.values():
+            if dep not in self.stages:
+                raise ValueError(f"Stage {name!r} depends on unknown stage {dep!r}")
+        self.stages[name] = {
+            "fn": fn,
+            "deps": deps,
+            "params": params or {},
+            "code": code_fingerprint([fn, *code]),
+        }
+        self._keys.clear()
+
+    def key(self, name):
+        if name not in self._keys:
+            stage = self.stages[name]
+            payload = json.dumps({
+                "version": PIPELINE_VERSION,
+                "stage": name,
+                "params": stage["params"],
+                "code": stage["code"],
+                "deps": {local: self.key(dep) for local, dep in sorted(stage["deps"].items())},
+            }, sort_keys=True, default=str)
+            self._keys[name] = hashlib.sha256(payload.encode()).hexdigest()[:16]
+        return self._keys[name]
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, re.sub(r"[^\w.-]+", "_", name), f"{self.key(name)}.pkl")
+
+    def is_stale(self, name):
+        return not os.path.exists(self._path(name))
+
+    def _get(self, name, runtime):
+        if name in self._memory:
+            return self._memory[name]
+
+        path = self._path(name)
+        if os.path.exists(path):
+            print(f">> [cached]     {name} ({self.key(name)})")
+            with open(path, "rb") as f:
+                artifact = pickle.load(f)
+        else:
+            print(f">> [recompute]  {name} ({self.key(name)})")
+            stage = self.stages[name]
+            inputs = {local: self._get(dep, runtime) for local, dep in stage["deps"].items()}
+            artifact = stage["fn"](inputs, stage["params"], runtime)
+
+            # write-then-rename so an interrupted run never leaves a truncated artifact behind
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(artifact, f)
+            os.replace(path + ".tmp", path)
+
+        self._memory[name] = artifact
+        return artifact
+
+    def run(self, targets=None, runtime=None):
+        """:return: {target: artifact}, computing only the stale stages the targets need"""
+        targets = list(self.stages) if targets is None else list(targets)
+        runtime = runtime or {}
+        return {name: self._get(name, runtime) for name in targets}
+
+    def forget(self, names):
+        """Drops in-memory copies (artifacts stay on disk), e.g. completions after scoring."""
+        for name in names:
+            self._memory.pop(name, None)
+
+
+# -------------------------------------------------------------------------
+# Stages of the CoT baseline experiment
+# -------------------------------------------------------------------------
+def _dataset_stage(inputs, params, runtime):
+    gen = MechanisticTaskGenerator(seed=params["seed"])
+    dataset = generateDataset(gen, params["examples_per_task"])
+    for i, item in enumerate(dataset):
+        item["id"] = i
+    return dataset
+
+def _exemplars_stage(inputs, params, runtime):
+    # own seed, so the exemplars don't depend on whether the dataset was regenerated in this run
+    gen = MechanisticTaskGenerator(seed=params["seed"])
+    return generateExemplars(generator=gen, num_exemplars=params["num_exemplars"])
+
+def _prompts_stage(inputs, params, runtime):
+    return [{
+        "id": item["id"],
+        "task_class": item["task_class"],
+        "clean": {
+            "prompt": buildPrompt(task_item=item, exemplars=inputs["exemplars"]),  # Few-Shot Prompt
+            "answer": item['clean']['answer'],
+        },
+    } for item in inputs["dataset"]]
+
+def _tokenization_stage(inputs, params, runtime):
+    from transformer_lens.loading_from_pretrained import get_pretrained_model_config
+    from scheduler import prompt_token_lengths
+
+    cfg = get_pretrained_model_config(params["model_name"])
+    prompts = inputs["prompts"]
+    lengths = prompt_token_lengths(cfg, [item['clean']['prompt'] for item in prompts])
+    return {item["id"]: n for item, n in zip(prompts, lengths)}
+
+def _require_model(runtime, stage):
+    if "model" not in runtime:
+        raise RuntimeError(f"Stage {stage} is stale and needs a loaded model (runtime['model'])")
+    return runtime["model"]
+
+def _completions_stage(inputs, params, runtime):
+    model = _require_model(runtime, "completions")
+    runner = CoTBaselineRunner(
+        model=model,
+        model_name=params["model_name"],
+        draft_model=runtime.get("draft_model")
+    )
+    tasks = [item for item in inputs["prompts"] if item["task_class"] == params["task_class"]]
+    return runner.generate_completions(tasks, batch_size=runtime.get("batch_size", 1), max_new_tokens=params["max_new_tokens"])
+
+def _extractions_stage(inputs, params, runtime):
+    return [{
+        "id": c["id"],
+        "task_class": c["task_class"],
+        "predicted_answer": extract_final(c["task_class"], c["generated_cot"], c["early_answer"]),
+        "early_stop": c["early_answer"] is not None,
+    } for c in inputs["completions"]]
+
+def _scores_stage(inputs, params, runtime):
+    answers = {item["id"]: item['clean']['answer'] for item in inputs["prompts"]}
+    cots = {c["id"]: c["generated_cot"] for c in inputs["completions"]}
+    rows = []
+    for e in inputs["extractions"]:
+        rows.append({
+            "id": e["id"],
+            "model_name": params["model_name"],
+            "task_class": e["task_class"],
+            "generated_cot": cots[e["id"]],
+            "predicted_answer": e["predicted_answer"],
+            "early_stop": e["early_stop"],
+            "ground_truth": answers[e["id"]],
+            "is_correct": is_correct_answer(e["predicted_answer"], answers[e["id"]]),
+        })
+    return rows
+
+def _metrics_stage(inputs, params, runtime):
+    streaming = StreamingMetrics(params["required_components"], n_bootstrap=params["n_bootstrap"], seed=params["seed"])
+    for name in sorted(inputs):
+        streaming.update(inputs[name])
+    return streaming.summary()
+
+def _patching_stage(inputs, params, runtime):
+    model = _require_model(runtime, "patching")
+    tasks = [item for item in inputs["dataset"] if item["task_class"] == params["task_class"]][:params["n_items"]]
+    results = []
+    for task in tasks:
+        try:
+            best_head, recovery = patch_heads(model, task)
+        except Exception as e:
+            # answers that are not a single token can't be patched with a logit diff
+            print(f"! ----- Patching skipped item {task['id']}: {e}")
+            continue
+        results.append({"id": task["id"], "best_head": best_head, "recovery": recovery})
+    return results
+
+
+def model_short_name(model_name):
+    return model_name.split("/")[-1]
+
+def completions_stage(model_name, task_class):
+    return f"completions/{model_short_name(model_name)}/{task_class}"
+
+def scores_stage(model_name, task_class):
+    return f"scores/{model_short_name(model_name)}/{task_class}"
+
+def patching_stage(model_name, task_class):
+    return f"patching/{model_short_name(model_name)}/{task_class}"
+
+def tokenization_stage(model_name):
+    return f"tokenization/{model_short_name(model_name)}"
+
+
+def build_experiment_pipeline(model_names, examples_per_task=50, num_exemplars=8, seed=42, exemplar_seed=43,
+                              max_new_tokens=100, dtype="float16", quantize_int8=False, compile=False,
+                              n_patch_items=8, required_components=(), n_bootstrap=1000, cache_dir=".pipeline_cache"):
+    """
+    generate dataset -> build exemplars -> format prompts -> tokenize -> generate -> extract -> score -> metrics
+                                                                               (dataset) -> patch
+    Generation / patching are keyed per (model, task_class) and need a loaded model in runtime.
+    dtype / quantize_int8 / compile describe how the model is executed (see CPUProfile); they change
+    the model's outputs, so they are part of the generation and patching keys.
+    """
+    pipeline = Pipeline(cache_dir)
+    pipeline.add("dataset", _dataset_stage,
+                 params={"seed": seed, "examples_per_task": examples_per_task},
+                 code=[generateDataset, MechanisticTaskGenerator])
+    pipeline.add("exemplars", _exemplars_stage,
+                 params={"seed": exemplar_seed, "num_exemplars": num_exemplars},
+                 code=[generateExemplars, MechanisticTaskGenerator])
+    pipeline.add("prompts", _prompts_stage, deps=["dataset", "exemplars"], code=[buildPrompt])
+
+    # Generation: runner (stop strings), decoding loops / KV-cache rollback and the streaming
+    # extractors that stop it. The whole-text fallback extractors are left out on purpose, so
+    # editing them only recomputes extractions and scores.
+    generation_code = [
+        CoTBaselineRunner.__init__, CoTBaselineRunner.generate_completions, CoTBaselineRunner._generate,
+        CoTBaselineRunner._generate_speculative, CoTBaselineRunner._make_extractor,
+        decoding.greedy_generate, decoding.batched_greedy_generate, decoding.speculative_generate,
+        decoding.left_pad_prompts, decoding._init_cache, decoding._cache_len, decoding._truncate_cache,
+        decoding._forward, decoding._sync_cache,
+        answer_extraction.StreamingAnswerExtractor, answer_extraction.IncrementalDetokenizer,
+        answer_extraction.FINAL_PATTERNS, answer_extraction.DEFAULT_STOP_STRINGS,
+    ]
+    # whole-text fallback extractors and the module-level regexes they use
+    extraction_code = [
+        extract_final, answer_extraction.FALLBACK_EXTRACTORS,
+        answer_extraction._NUMERIC_EXPLICIT, answer_extraction._INTEGER,
+    ]
+    execution = {"dtype": dtype, "quantize_int8": quantize_int8, "compile": compile}
+    score_stages = []
+    for model_name in model_names:
+        pipeline.add(tokenization_stage(model_name), _tokenization_stage, deps=["prompts"],
+                     params={"model_name": model_name}, code=[scheduler.prompt_token_lengths])
+        for task_class in TASK_CLASSES:
+            completions = completions_stage(model_name, task_class)
+            extractions = f"extractions/{model_short_name(model_name)}/{task_class}"
+            pipeline.add(completions, _completions_stage, deps=["prompts"],
+                         params={"model_name": model_name, "task_class": task_class,
+                                 "max_new_tokens": max_new_tokens, **execution},
+                         code=generation_code)
+            pipeline.add(extractions, _extractions_stage, deps={"completions": completions},
+                         code=extraction_code)
+            pipeline.add(scores_stage(model_name, task_class), _scores_stage,
+                         deps={"prompts": "prompts", "completions": completions, "extractions": extractions},
+                         params={"model_name": model_name}, code=[is_correct_answer])
+            pipeline.add(patching_stage(model_name, task_class), _patching_stage, deps=["dataset"],
+                         params={"model_name": model_name, "task_class": task_class,
+                                 "n_items": n_patch_items, **execution},
+                         code=[patch_heads])
+            score_stages.append(scores_stage(model_name, task_class))
+
+    pipeline.add("metrics", _metrics_stage, deps=score_stages,
+                 params={"required_components": list(required_components), "n_bootstrap": n_bootstrap, "seed": seed},
+                 code=[metrics])
+    return pipeline
+
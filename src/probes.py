@@ -0,0 +1,270 @@
+import os
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from decoding import gather_resid
+
+GIB = 1024 ** 3
+
+# latent variables the generator labels, per task class
+PROBE_VARIABLES = {
+    "CBLG": ["gate_state"],                               # Even / Odd
+    "multiway_branching": ["selector_val", "active_op"],  # (x + y) % 3 and the branch it selects
+    "Parity_PAT": ["predicate_5_validity"],               # the flipped predicate (clean = valid)
+}
+
+
+def _label(item, side, variable):
+    if variable == "predicate_5_validity":
+        return side == "clean"
+    return item[side][variable]
+
+def probe_examples(items, variables, n_folds=5):
+    """
+    Both sides of every generated pair become a probe example.
+    Clean and corrupt prompts of a pair share a fold, so the held-out fold never sees the
+    other half of a pair it is tested on.
+    :return: (list of (prompt, [label index per variable], fold), {variable: sorted class values})
+    """
+    raw = [(item[side]['prompt'], [_label(item, side, v) for v in variables], i % n_folds)
+           for i, item in enumerate(items) for side in ["clean", "corrupt"]]
+    classes = {v: sorted({labels[j] for _, labels, _ in raw}, key=str) for j, v in enumerate(variables)}
+    examples = [(prompt, [classes[v].index(labels[j]) for j, v in enumerate(variables)], fold)
+                for prompt, labels, fold in raw]
+    return examples, classes
+
+
+# -------------------------------------------------------------------------
+# Activation collection (in memory or streamed to disk)
+# -------------------------------------------------------------------------
+class ActivationShards:
+    """
+    Residual activations X [n, layers, positions, d_model] (fp16), labels y [n, variables] and
+    folds [n], split into shards. With a directory, shards live on disk and are loaded one
+    at a time while iterating, so the full set never has to fit in memory.
+    """
+    def __init__(self, store_dir=None):
+        self.store_dir = store_dir
+        self.shards = []
+        self.n = 0
+        if store_dir is not None:
+            os.makedirs(store_dir, exist_ok=True)
+
+    def append(self, X, y, folds):
+        shard = {"X": X, "y": y, "folds": folds}
+        if self.store_dir is not None:
+            path = os.path.join(self.store_dir, f"shard_{len(self.shards):05d}.pt")
+            torch.save(shard, path)
+            shard = path
+        self.shards.append(shard)
+        self.n += X.shape[0]
+
+    def __iter__(self):
+        for shard in self.shards:
+            yield torch.load(shard) if isinstance(shard, str) else shard
+
+
+class ProbeActivationCollector:
+    """Gathers resid_post at chosen positions (offsets from the end of the prompt) for every layer."""
+    def __init__(self, model, layers=None, positions=(-1,)):
+        self.model = model
+        self.layers = list(range(model.cfg.n_layers)) if layers is None else list(layers)
+        self.positions = list(positions)
+
+    def _batch_activations(self, prompts):
+        resid = gather_resid(self.model, prompts, self.layers, self.positions)
+        return resid.to("cpu", torch.float16)  # [B, L, P, d_model]
+
+    def collect(self, examples, batch_size=32, store_dir=None, shard_size=2048):
+        shards = ActivationShards(store_dir)
+        buffer = []
+        for start in tqdm(range(0, len(examples), batch_size)):
+            batch = examples[start:start + batch_size]
+            buffer.append((
+                self._batch_activations([prompt for prompt, _, _ in batch]),
+                torch.tensor([labels for _, labels, _ in batch]),
+                torch.tensor([fold for _, _, fold in batch]),
+            ))
+            if sum(x.shape[0] for x, _, _ in buffer) >= shard_size:
+                shards.append(*[torch.cat(parts) for parts in zip(*buffer)])
+                buffer = []
+        if buffer:
+            shards.append(*[torch.cat(parts) for parts in zip(*buffer)])
+        return shards
+
+
+# -------------------------------------------------------------------------
+# Batched probe fitting: every (layer, position) is an independent problem in one batched solve
+# -------------------------------------------------------------------------
+def _feature_stats(shards):
+    """Per-(layer*position, feature) mean and std, one streaming pass."""
+    total = sq = None
+    for shard in shards:
+        X = shard["X"].flatten(1, 2).double()  # [n, G, d]
+        total = X.sum(0) if total is None else total + X.sum(0)
+        sq = (X ** 2).sum(0) if sq is None else sq + (X ** 2).sum(0)
+    mean = total / shards.n
+    std = (sq / shards.n - mean ** 2).clamp(min=1e-12).sqrt()
+    return mean.float(), std.float()
+
+def _design(X, block, mean, std):
+    """Standardized features for a block of groups plus a bias column: [n, Gb, d + 1]."""
+    Z = (X.flatten(1, 2)[:, block].float() - mean[block]) / std[block]
+    return torch.cat([Z, torch.ones(*Z.shape[:-1], 1)], dim=-1)
+
+def _group_blocks(n_groups, bytes_per_group, max_memory_bytes):
+    size = max(1, min(n_groups, int(max_memory_bytes // max(bytes_per_group, 1))))
+    return [slice(i, min(i + size, n_groups)) for i in range(0, n_groups, size)]
+
+@torch.no_grad()
+def _held_out_accuracy(shards, var_idx, block, mean, std, W, n_folds):
+    """Accuracy of each fold's probes on that fold's held-out examples: [k, Gb]."""
+    correct = torch.zeros(n_folds, W.shape[1])
+    counts = torch.zeros(n_folds, 1)
+    for shard in shards:
+        Z = _design(shard["X"], block, mean, std)
+        y, folds = shard["y"][:, var_idx], shard["folds"]
+        pred = torch.einsum("ngd,kgdc->kngc", Z, W).argmax(dim=-1)  # [k, n, Gb]
+        pred = pred[folds, torch.arange(len(folds))]  # each example scored by the probe that never saw it
+        hits = (pred == y[:, None]).float()
+        correct.index_add_(0, folds, hits)
+        counts.index_add_(0, folds, torch.ones(len(folds), 1))
+    return correct / counts.clamp(min=1)
+
+@torch.no_grad()
+def fit_ridge_probes(shards, var_idx, n_classes, n_folds=5, ridge=1e-2, max_memory_bytes=2 * GIB):
+    """
+    Ridge regression onto +-1 one-hot targets, argmax to classify.
+    Sufficient statistics (X^T X, X^T Y) are streamed per fold; the training statistics of fold f
+    are total - fold f, and all (fold, layer, position) systems are solved in one batched call.
+    :return: (mean accuracy [G], std across folds [G]) with G = layers * positions
+    """
+    mean, std = _feature_stats(shards)
+    n_groups, d = mean.shape
+    D = d + 1
+    blocks = _group_blocks(n_groups, 2 * n_folds * D * D * 4, max_memory_bytes)
+
+    accuracy = []
+    for block in blocks:
+        n_block = block.stop - block.start
+        S_xx = torch.zeros(n_folds, n_block, D, D)
+        S_xy = torch.zeros(n_folds, n_block, D, n_classes)
+        fold_n = torch.zeros(n_folds)
+        for shard in shards:
+            Z = _design(shard["X"], block, mean, std)
+            Y = F.one_hot(shard["y"][:, var_idx], n_classes).float() * 2 - 1
+            folds = shard["folds"]
+            for f in range(n_folds):
+                m = folds == f
+                S_xx[f] += torch.einsum("ngd,nge->gde", Z[m], Z[m])
+                S_xy[f] += torch.einsum("ngd,nc->gdc", Z[m], Y[m])
+                fold_n[f] += m.sum()
+
+        train_xx = S_xx.sum(0, keepdim=True) - S_xx
+        train_xy = S_xy.sum(0, keepdim=True) - S_xy
+        del S_xx, S_xy
+        # features are standardized, so one ridge strength fits every layer; the bias is not penalized
+        reg = torch.eye(D)
+        reg[-1, -1] = 0
+        train_n = fold_n.sum() - fold_n
+        train_xx += ridge * train_n.view(-1, 1, 1, 1) * reg
+        W = torch.linalg.solve(train_xx, train_xy)  # [k, Gb, D, C]
+        del train_xx, train_xy
+
+        accuracy.append(_held_out_accuracy(shards, var_idx, block, mean, std, W, n_folds))
+
+    accuracy = torch.cat(accuracy, dim=1)  # [k, G]
+    return accuracy.mean(0), accuracy.std(0)
+
+def fit_logistic_probes(shards, var_idx, n_classes, n_folds=5, epochs=20, lr=1e-2, weight_decay=1e-4,
+                        max_memory_bytes=2 * GIB):
+    """
+    Multinomial logistic probes for every (fold, layer, position) at once, trained with Adam on
+    one [folds, groups, d + 1, classes] weight tensor while streaming the shards each epoch.
+    :return: (mean accuracy [G], std across folds [G]) with G = layers * positions
+    """
+    mean, std = _feature_stats(shards)
+    n_groups, d = mean.shape
+    D = d + 1
+    # weights + Adam state (x3) + gradient, per group
+    blocks = _group_blocks(n_groups, 5 * n_folds * D * n_classes * 4, max_memory_bytes)
+
+    accuracy = []
+    for block in blocks:
+        n_block = block.stop - block.start
+        W = torch.zeros(n_folds, n_block, D, n_classes, requires_grad=True)
+        optimizer = torch.optim.Adam([W], lr=lr)
+        fold_ids = torch.arange(n_folds)[:, None]
+
+        for _ in range(epochs):
+            for shard in shards:
+                Z = _design(shard["X"], block, mean, std)
+                y, folds = shard["y"][:, var_idx], shard["folds"]
+                train_mask = (folds[None, :] != fold_ids).float()  # [k, n]
+
+                log_probs = torch.einsum("ngd,kgdc->kngc", Z, W).log_softmax(dim=-1)
+                target = y.view(1, -1, 1, 1).expand(n_folds, -1, n_block, 1)
+                nll = -log_probs.gather(-1, target).squeeze(-1)  # [k, n, Gb]
+                loss = (nll * train_mask[:, :, None]).sum() / train_mask.sum().clamp(min=1)
+                loss = loss + weight_decay * (W[:, :, :-1] ** 2).sum()
+
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+        accuracy.append(_held_out_accuracy(shards, var_idx, block, mean, std, W.detach(), n_folds))
+
+    accuracy = torch.cat(accuracy, dim=1)
+    return accuracy.mean(0), accuracy.std(0)
+
+
+# -------------------------------------------------------------------------
+# Entry point
+# -------------------------------------------------------------------------
+def run_probes(model, dataset, layers=None, positions=(-1,), method="ridge", n_folds=5, batch_size=32,
+               store_dir=None, output_file=None, **fit_kwargs):
+    """
+    Probes every labelled latent variable at every (layer, position).
+    :param dataset: list[dict] of raw generator pairs (clean + corrupt sides are both used)
+    :param method: "ridge" or "logistic"
+    :param store_dir: if given, activations are streamed to disk there instead of kept in memory
+    :return: {task_class: {variable: {"accuracy": [layers x positions], "accuracy_std", "classes", ...}}}
+    """
+    if method not in ["ridge", "logistic"]:
+        raise ValueError(f"Unknown probe method {method!r}, expected 'ridge' or 'logistic'")
+    fit = fit_ridge_probes if method == "ridge" else fit_logistic_probes
+    collector = ProbeActivationCollector(model, layers, positions)
+    n_layers, n_pos = len(collector.layers), len(collector.positions)
+
+    results = {}
+    for task_class, variables in PROBE_VARIABLES.items():
+        items = [item for item in dataset if item["task_class"] == task_class]
+        if not items:
+            continue
+        print(f">> Probing {task_class} ({2 * len(items)} examples) for {variables}...")
+        examples, classes = probe_examples(items, variables, n_folds)
+        class_dir = os.path.join(store_dir, task_class) if store_dir is not None else None
+        shards = collector.collect(examples, batch_size=batch_size, store_dir=class_dir)
+
+        results[task_class] = {}
+        for var_idx, variable in enumerate(variables):
+            acc, acc_std = fit(shards, var_idx, len(classes[variable]), n_folds=n_folds, **fit_kwargs)
+            acc, acc_std = acc.reshape(n_layers, n_pos), acc_std.reshape(n_layers, n_pos)
+            best = acc.argmax().item()
+            print(f"   {variable}: best {acc.max().item():.2%} at layer {collector.layers[best // n_pos]}, "
+                  f"position {collector.positions[best % n_pos]} (chance {1 / len(classes[variable]):.2%})")
+            results[task_class][variable] = {
+                "accuracy": acc,
+                "accuracy_std": acc_std,
+                "classes": classes[variable],
+                "layers": collector.layers,
+                "positions": collector.positions,
+                "n": len(examples),
+                "method": method,
+            }
+
+    if output_file is not None:
+        torch.save(results, output_file)
+        print(f">>> Probe results in {output_file}")
+    return results
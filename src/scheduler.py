@@ -0,0 +1,355 @@
+import os
+import time
+import resource
+import torch
+from transformer_lens.loading_from_pretrained import get_pretrained_model_config
+
+from setup import clear_memory
+
+GIB = 1024 ** 3
+
+
+def _dtype_bytes(dtype):
+    return torch.tensor([], dtype=dtype).element_size()
+
+
+def _fmt_gib(n_bytes):
+    return f"{n_bytes / GIB:.2f} GiB" if n_bytes is not None else "n/a"
+
+
+def detect_memory_budget(device="cuda"):
+    """Total memory (bytes) of the device we're going to run on."""
+    if device.startswith("cuda") and torch.cuda.is_available():
+        return torch.cuda.get_device_properties(torch.device(device)).total_memory
+    # CPU: physical RAM
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def _reset_cpu_peak():
+    """Resets this process's peak resident set (VmHWM) on Linux; False where that is not possible."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _read_cpu_peak():
+    """Peak resident set (bytes) since the last _reset_cpu_peak, or None."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024  # reported in kB
+    except OSError:
+        pass
+    return None
+
+
+def prompt_token_lengths(cfg, prompts):
+    """Token count per prompt (incl. BOS) using only the model's tokenizer, so weights stay on disk."""
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(cfg.tokenizer_name)
+    return [len(ids) + 1 for ids in tokenizer(prompts, add_special_tokens=False)["input_ids"]]
+
+
+# -------------------------------------------------------------------------
+# Memory estimates (from the HookedTransformerConfig, no weights needed)
+# -------------------------------------------------------------------------
+def _norm_params(cfg):
+    return {"LN": 2, "RMS": 1}.get(cfg.normalization_type, 0) * cfg.d_model
+
+def estimate_param_bytes(cfg, dtype=None):
+    """
+    Bytes held by a HookedTransformer built from cfg: weights plus buffers.
+    Buffers are not small: every attention layer keeps an n_ctx x n_ctx causal mask (bool) and,
+    with rotary embeddings, n_ctx x rotary_dim sin / cos tables.
+    """
+    dtype = dtype or cfg.dtype
+    d_model, d_head, n_heads = cfg.d_model, cfg.d_head, cfg.n_heads
+    n_kv_heads = getattr(cfg, "n_key_value_heads", None) or n_heads
+    d_vocab_out = cfg.d_vocab_out if cfg.d_vocab_out > 0 else cfg.d_vocab
+    norm = _norm_params(cfg)
+
+    embed = cfg.d_vocab * d_model + (d_model + 1) * d_vocab_out  # W_E, W_U, b_U
+    if cfg.positional_embedding_type != "rotary":
+        embed += cfg.n_ctx * d_model
+
+    # W_Q, W_O (+ b_Q) over all heads; W_K, W_V (+ b_K, b_V) over the (possibly grouped) kv heads; b_O
+    attn = (d_model + 1) * d_head * (n_heads + 2 * n_kv_heads) + n_heads * d_head * d_model + d_model
+    block_norms = norm * (1 if cfg.attn_only else 2)
+    if getattr(cfg, "use_normalization_before_and_after", False):
+        block_norms *= 2
+    mlp = 0
+    if not cfg.attn_only:
+        # W_in, W_out (+ W_gate), b_in, b_out
+        mlp = d_model * cfg.d_mlp * (3 if cfg.gated_mlp else 2) + cfg.d_mlp + d_model
+        num_experts = getattr(cfg, "num_experts", None)
+        if num_experts:
+            mlp = mlp * num_experts + d_model * num_experts  # experts + router
+
+    n_params = embed + cfg.n_layers * (attn + block_norms + mlp) + norm  # + ln_final
+
+    # per-layer buffers: causal mask (bool, not cast with the model), IGNORE scalar, rotary tables
+    mask_bytes = cfg.n_layers * cfg.n_ctx * cfg.n_ctx
+    n_buffer_elements = cfg.n_layers
+    if cfg.positional_embedding_type == "rotary":
+        n_buffer_elements += cfg.n_layers * 2 * cfg.n_ctx * (cfg.rotary_dim or d_head)
+
+    return (n_params + n_buffer_elements) * _dtype_bytes(dtype) + mask_bytes
+
+
+def estimate_int8_bytes(cfg, dtype=None):
+    """
+    Extra bytes added by CPUProfile(quantize_int8=True): int8 copies of the MLP and unembedding
+    weights plus per-channel scales and bias copies, on top of the fp weights (which are kept).
+    """
+    dtype = dtype or cfg.dtype
+    d_model = cfg.d_model
+    d_vocab_out = cfg.d_vocab_out if cfg.d_vocab_out > 0 else cfg.d_vocab
+
+    int8 = d_model * d_vocab_out
+    fp = 2 * d_vocab_out  # scales + b_U
+    if not cfg.attn_only and cfg.act_fn != "solu_ln":  # SoLU MLPs are not quantized
+        int8 += cfg.n_layers * d_model * cfg.d_mlp * (3 if cfg.gated_mlp else 2)
+        # scales of W_in / W_out (+ W_gate) and copies of b_in (ungated only) / b_out: the same count either way
+        fp += cfg.n_layers * 2 * (cfg.d_mlp + d_model)
+    return int8 + fp * _dtype_bytes(dtype)
+
+
+def estimate_activation_bytes(cfg, batch_size, seq_len, dtype=None, safety=1.2):
+    """
+    Peak activation memory (bytes) for greedy generation under no_grad.
+    Layers run one at a time, so only a single block's transients are live, on top of
+    the KV cache for every layer and the logits of the prefill pass.
+    """
+    dtype = dtype or cfg.dtype
+    n_heads = cfg.n_heads
+    n_kv_heads = getattr(cfg, "n_key_value_heads", None) or n_heads
+    d_vocab_out = cfg.d_vocab_out if cfg.d_vocab_out > 0 else cfg.d_vocab
+    tokens = batch_size * seq_len
+
+    kv_cache = 2 * cfg.n_layers * tokens * n_kv_heads * cfg.d_head
+    resid = 4 * tokens * cfg.d_model  # resid_pre, normalized input, attn_out, mlp_out
+    attn = 2 * batch_size * n_heads * seq_len * seq_len  # scores + pattern
+    mlp = 0 if cfg.attn_only else tokens * cfg.d_mlp * (2 if cfg.gated_mlp else 1)
+    logits = tokens * d_vocab_out
+
+    n_elements = kv_cache + resid + attn + mlp + logits
+    return int(n_elements * _dtype_bytes(dtype) * safety)
+
+
+# -------------------------------------------------------------------------
+# Scheduler
+# -------------------------------------------------------------------------
+class MemoryBudgetScheduler:
+    """
+    Plans (model, task_class) jobs under a memory budget.
+    - models are packed into "waves" that stay resident together; each model is loaded exactly once
+    - a model only joins a wave if no job in it loses batch size compared to running alone
+    - batch size per job is the largest power of two whose estimated peak fits the budget
+    - load_dtype: dtype the weights are materialized in while loading, if the loader converts to
+      dtype afterwards (the CPU profile loads fp32 for its reference logits); each wave must also
+      fit its load peak
+    - int8_weights: the model also keeps int8 copies of its MLP / unembedding weights
+      (CPUProfile(quantize_int8=True)), counted as resident memory
+    """
+    def __init__(self, budget_bytes, dtype=torch.float16, max_batch_size=32, max_new_tokens=100, reserve_fraction=0.1,
+                 load_dtype=None, int8_weights=False):
+        self.budget_bytes = budget_bytes
+        # keep some headroom for the CUDA context / allocator fragmentation
+        self.usable_bytes = int(budget_bytes * (1 - reserve_fraction))
+        self.dtype = dtype
+        self.load_dtype = load_dtype or dtype
+        self.int8_weights = int8_weights
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.configs = {}
+
+    def add_model(self, model_name, cfg=None):
+        """Registers a model; only its config is fetched, not the weights."""
+        if cfg is None:
+            cfg = get_pretrained_model_config(model_name, dtype=self.dtype)
+        self.configs[model_name] = cfg
+        return cfg
+
+    def pick_batch_size(self, cfg, resident_bytes, seq_len):
+        """Largest power-of-two batch that fits next to resident_bytes of weights (0 if none does)."""
+        batch_size = self.max_batch_size
+        while batch_size >= 1:
+            act = estimate_activation_bytes(cfg, batch_size, seq_len, self.dtype)
+            if resident_bytes + act <= self.usable_bytes:
+                return batch_size
+            batch_size //= 2
+        return 0
+
+    def _seq_len(self, job):
+        return max(job["prompt_lengths"]) + self.max_new_tokens
+
+    def _resident_bytes(self, model_name):
+        cfg = self.configs[model_name]
+        resident = estimate_param_bytes(cfg, self.dtype)
+        if self.int8_weights:
+            resident += estimate_int8_bytes(cfg, self.dtype)
+        return resident
+
+    def _load_peak(self, model_names):
+        """Models are loaded one after the other: the peak is the others resident + one model at load_dtype."""
+        resident = {m: self._resident_bytes(m) for m in model_names}
+        return max(
+            sum(resident.values()) - resident[m]
+            + max(resident[m], estimate_param_bytes(self.configs[m], self.load_dtype))
+            for m in model_names
+        )
+
+    def _wave_batch_sizes(self, model_names, jobs):
+        if self._load_peak(model_names) > self.usable_bytes:
+            return [0] * len(jobs)
+        resident = sum(self._resident_bytes(m) for m in model_names)
+        return [
+            self.pick_batch_size(self.configs[job["model_name"]], resident, self._seq_len(job))
+            for job in jobs
+        ]
+
+    def plan(self, jobs):
+        """
+        :param jobs: list[dict] with "model_name", "task_class" and "prompt_lengths" (tokens per prompt)
+        :return: dict with "waves" (each with "models" and ordered "jobs") and "skipped" jobs
+        """
+        for job in jobs:
+            if job["model_name"] not in self.configs:
+                self.add_model(job["model_name"])
+
+        jobs_by_model = {}
+        for job in jobs:
+            jobs_by_model.setdefault(job["model_name"], []).append(dict(job))
+
+        # batch size each model gets when it has the device to itself
+        solo_batch = {}
+        skipped = []
+        for model_name, model_jobs in list(jobs_by_model.items()):
+            sizes = self._wave_batch_sizes([model_name], model_jobs)
+            if min(sizes) == 0:
+                print(f"! ----- {model_name} does not fit in {_fmt_gib(self.usable_bytes)} even at batch size 1, skipping")
+                skipped.extend(jobs_by_model.pop(model_name))
+                continue
+            solo_batch[model_name] = sizes
+
+        # first-fit decreasing by parameter memory
+        order = sorted(
+            jobs_by_model,
+            key=self._resident_bytes,
+            reverse=True,
+        )
+        waves = []
+        for model_name in order:
+            for wave in waves:
+                candidate = wave["models"] + [model_name]
+                candidate_jobs = [j for m in candidate for j in jobs_by_model[m]]
+                expected = [b for m in candidate for b in solo_batch[m]]
+                if self._wave_batch_sizes(candidate, candidate_jobs) == expected:
+                    wave["models"] = candidate
+                    break
+            else:
+                waves.append({"models": [model_name]})
+
+        # finalize jobs: grouped by model (so a model is never reloaded), then by task class
+        for wave in waves:
+            resident = sum(self._resident_bytes(m) for m in wave["models"])
+            wave["resident_bytes"] = resident
+            wave["load_peak_bytes"] = self._load_peak(wave["models"])
+            wave["jobs"] = []
+            for model_name in wave["models"]:
+                cfg = self.configs[model_name]
+                for job in sorted(jobs_by_model[model_name], key=lambda j: j["task_class"]):
+                    seq_len = self._seq_len(job)
+                    job["batch_size"] = self.pick_batch_size(cfg, resident, seq_len)
+                    job["planned_peak_bytes"] = resident + estimate_activation_bytes(cfg, job["batch_size"], seq_len, self.dtype)
+                    wave["jobs"].append(job)
+
+        return {"waves": waves, "skipped": skipped}
+
+    def describe(self, plan):
+        print(f">> Memory plan (budget {_fmt_gib(self.budget_bytes)}, usable {_fmt_gib(self.usable_bytes)})")
+        for i, wave in enumerate(plan["waves"]):
+            print(f"   Wave {i}: {wave['models']} resident ({_fmt_gib(wave['resident_bytes'])}, "
+                  f"load peak {_fmt_gib(wave['load_peak_bytes'])})")
+            for job in wave["jobs"]:
+                print(f"      {job['model_name']} / {job['task_class']}: batch {job['batch_size']}, "
+                      f"planned peak {_fmt_gib(job['planned_peak_bytes'])}")
+        for job in plan["skipped"]:
+            print(f"   SKIPPED {job['model_name']} / {job['task_class']}")
+
+    def run(self, plan, load_model, run_job):
+        """
+        Executes a plan wave by wave.
+        :param load_model: fn(model_name) -> HookedTransformer
+        :param run_job: fn(model, job, batch_size) -> anything
+        :return: list[dict], one report per job with planned and actual peak memory; "peak_scope" is
+                 "job" when the peak was reset before the job, "process" when only the lifetime
+                 high-water mark (ru_maxrss) was available
+        """
+        reports = []
+        use_cuda = torch.cuda.is_available()
+
+        for wave in plan["waves"]:
+            resident = {}
+            try:
+                for model_name in wave["models"]:
+                    resident[model_name] = load_model(model_name)
+                    print(f"{'-'*10} Successfully loaded {model_name}\n")
+
+                for job in wave["jobs"]:
+                    if use_cuda:
+                        torch.cuda.reset_peak_memory_stats()
+                        per_job = True
+                    else:
+                        per_job = _reset_cpu_peak()
+                    start = time.time()
+                    status = "ok"
+                    try:
+                        run_job(resident[job["model_name"]], job, job["batch_size"])
+                    except Exception as e:
+                        print(f"! ----- Failed {job['model_name']} / {job['task_class']}: {e}\n")
+                        status = f"failed: {e}"
+
+                    if use_cuda:
+                        actual_peak = torch.cuda.max_memory_allocated()
+                    else:
+                        actual_peak = _read_cpu_peak() if per_job else None
+                        if actual_peak is None:
+                            # ru_maxrss is in KiB on Linux; it is a process-wide high-water mark, not per job
+                            per_job = False
+                            actual_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+                    reports.append({
+                        "model_name": job["model_name"],
+                        "task_class": job["task_class"],
+                        "batch_size": job["batch_size"],
+                        "planned_peak_bytes": job["planned_peak_bytes"],
+                        "actual_peak_bytes": actual_peak,
+                        "peak_scope": "job" if per_job else "process",
+                        "seconds": time.time() - start,
+                        "status": status,
+                    })
+                    print(f">> {job['model_name']} / {job['task_class']}: planned {_fmt_gib(job['planned_peak_bytes'])}, "
+                          f"actual {_fmt_gib(actual_peak)}{'' if per_job else ' (process-wide peak)'}")
+            except Exception as e:
+                print(f"! ----- Failed to load wave {wave['models']}: {e}\n")
+                for job in wave["jobs"]:
+                    reports.append({
+                        "model_name": job["model_name"],
+                        "task_class": job["task_class"],
+                        "batch_size": job["batch_size"],
+                        "planned_peak_bytes": job["planned_peak_bytes"],
+                        "actual_peak_bytes": None,
+                        "peak_scope": None,
+                        "seconds": 0.0,
+                        "status": f"load failed: {e}",
+                    })
+            finally:
+                resident.clear()
+                clear_memory()
+                print(">>> Memory cleared")
+
+        return reports
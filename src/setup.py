@@ -30,12 +30,12 @@ def generateExemplars(generator, num_exemplars):
     """
     exemplars = dict()
     
-    for task_class in ["linear_symbolic", "CBLG", "MultiWay", "Parity_PAT"]:
+    for task_class in ["linear_symbolic", "CBLG", "multiway_branching", "Parity_PAT"]:
       if task_class == "linear_symbolic":
           tasks = [generator.generate_linear_pair() for _ in range(num_exemplars)]
       elif task_class == "CBLG":
           tasks = [generator.generate_cblg_pair() for _ in range(num_exemplars)]
-      elif task_class == "MultiWay":
+      elif task_class == "multiway_branching":
           tasks = [generator.generate_multiway_pair() for _ in range(num_exemplars)]
       elif task_class == "Parity_PAT":
           tasks = [generator.generate_parity_pat_pair() for _ in range(num_exemplars)]
@@ -61,7 +61,7 @@ def buildPrompt(task_item, exemplars):
   # Standard CoT Format
   full_prompt = (
       f"Solve the following problems step-by-step.\n\n"
-      f"{exemplars}"
+      f"{curr_exemplars}"
       f"Q: {current_q}\nA: Let's think step by step." # Trigger phrase
   )
 
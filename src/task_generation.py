@@ -278,6 +278,65 @@ def generateDataset(generator, examples_per_task=500):
     return full_dataset
 
 
+def patch_heads(model, task):
+    """
+    Naive activation-patching sweep: patches each head's z from the clean run into the corrupted run
+    and measures how much of the clean - corrupt logit diff it recovers.
+    :param task: dict (generator pair with clean / corrupt prompt and answer)
+    :return: (best head as "L{layer}H{head}", its recovery fraction)
+    """
+    clean_prompt = task['clean']['prompt']
+    corrupt_prompt = task['corrupt']['prompt']
+    clean_ans = task['clean']['answer']
+    corrupt_ans = task['corrupt']['answer']
+    
+    # A. Cache Clean/Corrupt
+    # Note: We assume model is already loaded in 'model'
+    logits_clean, cache_clean = model.run_with_cache(clean_prompt)
+    logits_corrupt, cache_corrupt = model.run_with_cache(corrupt_prompt)
+    
+    # B. Calculate "Clean - Corrupt" Logit Diff direction
+    # We want to restore the clean answer
+    clean_tok = model.to_single_token(clean_ans)
+    corrupt_tok = model.to_single_token(corrupt_ans)
+    
+    def get_logit_diff(logits, answer_token_index=0):
+        return logits[0, -1, clean_tok] - logits[0, -1, corrupt_tok]
+
+    base_diff = get_logit_diff(logits_clean) - get_logit_diff(logits_corrupt)
+    
+    # C. Patch Every Head (Naive Sweep)
+    best_head = "Unknown"
+    best_recovery = -1.0
+    
+    n_layers = model.cfg.n_layers
+    n_heads = model.cfg.n_heads
+    
+    for layer in range(n_layers):
+        for head in range(n_heads):
+            # Hook function to swap ONE head
+            def patch_head_hook(activations, hook):
+                activations[:, :, head, :] = cache_clean[hook.name][:, :, head, :]
+                return activations
+            
+            # Run with hook
+            hook_name = utils.get_act_name("z", layer)
+            patched_logits = model.run_with_hooks(
+                corrupt_prompt,
+                fwd_hooks=[(hook_name, patch_head_hook)]
+            )
+            
+            # Check performance
+            patched_diff = get_logit_diff(patched_logits) - get_logit_diff(logits_corrupt)
+            recovery = patched_diff / base_diff
+            
+            if recovery > best_recovery:
+                best_recovery = recovery
+                best_head = f"L{layer}H{head}"
+
+    return best_head, float(best_recovery)
+
+
 def oldexemplars(model, generator, task_class, num_exemplars):
     """
     generate examples and ientify their top causal heads to form few-shot prompt for experiments 
@@ -306,61 +365,13 @@ def oldexemplars(model, generator, task_class, num_exemplars):
 
     # 2. Run Rapid Patching (Abridged Version)
     for i, task in enumerate(tasks):
-        clean_prompt = task['clean']['prompt']
-        corrupt_prompt = task['corrupt']['prompt']
-        clean_ans = task['clean']['answer']
-        corrupt_ans = task['corrupt']['answer']
-        
-        # A. Cache Clean/Corrupt
-        # Note: We assume model is already loaded in 'model'
-        logits_clean, cache_clean = model.run_with_cache(clean_prompt)
-        logits_corrupt, cache_corrupt = model.run_with_cache(corrupt_prompt)
-        
-        # B. Calculate "Clean - Corrupt" Logit Diff direction
-        # We want to restore the clean answer
-        clean_tok = model.to_single_token(clean_ans)
-        corrupt_tok = model.to_single_token(corrupt_ans)
-        
-        def get_logit_diff(logits, answer_token_index=0):
-            return logits[0, -1, clean_tok] - logits[0, -1, corrupt_tok]
-
-        base_diff = get_logit_diff(logits_clean) - get_logit_diff(logits_corrupt)
-        
-        # C. Patch Every Head (Naive Sweep)
-        best_head = "Unknown"
-        best_recovery = -1.0
-        
-        n_layers = model.cfg.n_layers
-        n_heads = model.cfg.n_heads
-        
-        for layer in range(n_layers):
-            for head in range(n_heads):
-                # Hook function to swap ONE head
-                def patch_head_hook(activations, hook):
-                    activations[:, :, head, :] = cache_clean[hook.name][:, :, head, :]
-                    return activations
-                
-                # Run with hook
-                hook_name = utils.get_act_name("z", layer)
-                patched_logits = model.run_with_hooks(
-                    corrupt_prompt,
-                    fwd_hooks=[(hook_name, patch_head_hook)]
-                )
-                
-                # Check performance
-                patched_diff = get_logit_diff(patched_logits) - get_logit_diff(logits_corrupt)
-                recovery = patched_diff / base_diff
-                
-                if recovery > best_recovery:
-                    best_recovery = recovery
-                    best_head = f"L{layer}H{head}"
-
+        best_head, best_recovery = patch_heads(model, task)
         print(f"   Exemplar {i+1}: Found Best Head {best_head} (Recovery: {best_recovery:.2%})")
         
         # Save the data needed to write the prompt
         exemplars.append({
-            "prompt_text": clean_prompt,
-            "answer": clean_ans,
+            "prompt_text": task['clean']['prompt'],
+            "answer": task['clean']['answer'],
             "top_head": best_head
         })
 
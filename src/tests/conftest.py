@@ -0,0 +1,38 @@
+import pytest
+
+
+# torch / transformer_lens are imported inside the helpers so the pure-Python tests
+# (answer extraction, pipeline) still collect without them
+def char_tokenizer(model):
+    """One token per character (BOS = 1), so config-built models need no tokenizer download."""
+    import torch
+
+    d_vocab = model.cfg.d_vocab
+
+    def to_tokens(text, prepend_bos=True):
+        return torch.tensor([[1] * prepend_bos + [2 + ord(c) % (d_vocab - 2) for c in text]])
+
+    def to_single_token(text):
+        tokens = to_tokens(text, prepend_bos=False)
+        assert tokens.shape[1] == 1, f"{text!r} is not a single token"
+        return tokens[0, 0].item()
+
+    model.to_tokens = to_tokens
+    model.to_single_token = to_single_token
+    return model
+
+
+@pytest.fixture(scope="session")
+def make_tiny_model():
+    """Factory for tiny config-built models on CPU, with the character tokenizer attached."""
+    from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+    def make(n_layers=2, d_model=32, d_head=8, d_vocab=64, n_ctx=128, seed=0):
+        cfg = HookedTransformerConfig(
+            n_layers=n_layers, d_model=d_model, d_head=d_head, n_heads=d_model // d_head, d_mlp=4 * d_model,
+            d_vocab=d_vocab, n_ctx=n_ctx, act_fn="gelu", normalization_type="LN", device="cpu", seed=seed,
+        )
+        model = HookedTransformer(cfg)
+        model.eval()
+        return char_tokenizer(model)
+    return make
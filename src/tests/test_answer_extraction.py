@@ -0,0 +1,61 @@
+from answer_extraction import StreamingAnswerExtractor, IncrementalDetokenizer, extract_numeric, extract_boolean
+
+
+class CharTokenizer:
+    """One token per character; enough to exercise the streaming path without a real tokenizer."""
+    def encode(self, text):
+        return [ord(c) for c in text]
+
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(chr(i) for i in ids)
+
+
+def stream(extractor, text):
+    """Feeds text token by token, returns how many tokens were consumed before the stop signal."""
+    for n, tok in enumerate(CharTokenizer().encode(text), start=1):
+        if extractor.feed_token(tok):
+            return n
+    return len(text)
+
+
+def test_numeric_answer_stops_once_committed():
+    text = "14 + 20 = 34. The result is 34. 34 - 12 = 22. So the answer is 22. Then we keep rambling on and on"
+    extractor = StreamingAnswerExtractor("linear_symbolic", CharTokenizer())
+    consumed = stream(extractor, text)
+    # stopped right after the character that terminates "22", not at "the result is 34"
+    assert consumed == text.index("answer is 22.") + len("answer is 22.")
+    assert extractor.result() == "22"
+
+
+def test_number_is_not_committed_early():
+    extractor = StreamingAnswerExtractor("CBLG", CharTokenizer())
+    assert not extractor.feed_text("the answer is 4")
+    assert extractor.feed_text("6 because")
+    assert extractor.result() == "46"
+
+
+def test_boolean_answer():
+    extractor = StreamingAnswerExtractor("Parity_PAT", CharTokenizer())
+    stream(extractor, "P1 is valid, P2 is not. Three checks are valid, so the answer is TRUE. Extra text")
+    assert extractor.answer == "True"
+
+
+def test_stop_string_cuts_text_and_falls_back():
+    extractor = StreamingAnswerExtractor("multiway_branching", CharTokenizer())
+    consumed = stream(extractor, "S = 1 so x * y = 56\n\nQ: Input: x=10")
+    assert extractor.text == "S = 1 so x * y = 56"
+    assert consumed == len("S = 1 so x * y = 56\n\n")
+    assert extractor.answer is None
+    assert extractor.result() == "56"
+
+
+def test_fallback_extractors():
+    assert extract_numeric("first 3 then -7") == "-7"
+    assert extract_numeric("nothing here") == "PARSE_ERROR"
+    assert extract_boolean("so it is false") == "False"
+
+
+def test_detokenizer_reassembles_text():
+    detok = IncrementalDetokenizer(CharTokenizer())
+    text = "the answer is 42."
+    assert "".join(detok.push(tok) for tok in CharTokenizer().encode(text)) == text
@@ -0,0 +1,62 @@
+import pytest
+import torch
+
+from attention_storage import AttentionPatternRecorder, AttentionPatternReader
+
+
+@pytest.fixture(scope="module")
+def model(make_tiny_model):
+    return make_tiny_model()
+
+
+dataset = [
+    {"id": 0, "task_class": "linear_symbolic", "clean": {"prompt": "Start with 5. Add 2.", "answer": "7"}},
+    {"id": 1, "task_class": "CBLG", "clean": {"prompt": "x=3, y=4. Gate", "answer": "13"}},
+    {"id": 2, "task_class": "linear_symbolic", "clean": {"prompt": "Start with 1.", "answer": "1"}},
+]
+
+
+def reference_patterns(model, text):
+    _, cache = model.run_with_cache(model.to_tokens(text))
+    return torch.stack([cache["pattern", layer][0] for layer in range(model.cfg.n_layers)])  # [L, H, Q, K]
+
+
+def test_fp16_round_trip(model, tmp_path):
+    recorder = AttentionPatternRecorder(model, query_positions=[-1], mode="fp16")
+    recorder.record(dataset, str(tmp_path), append_answer=True, shard_size=2)
+    reader = AttentionPatternReader(str(tmp_path))
+    assert len(reader) == 3
+    assert reader.items_for_class("linear_symbolic") == [0, 2]
+
+    for idx, task in enumerate(dataset):
+        text = task['clean']['prompt'] + " " + task['clean']['answer']
+        entry = reader.item(idx)
+        seq_len = model.to_tokens(text).shape[1]
+        answer_len = seq_len - model.to_tokens(task['clean']['prompt']).shape[1]
+        # final position plus every answer position (" 13" is three characters)
+        assert entry["query_positions"] == list(range(seq_len - answer_len, seq_len))
+
+        expected = reference_patterns(model, text)[:, :, entry["query_positions"]]
+        assert torch.allclose(reader.dense(idx), expected, atol=1e-3)
+        assert torch.allclose(reader.dense(idx, layer=1, head=2), expected[1, 2], atol=1e-3)
+
+
+def test_topk_round_trip(model, tmp_path):
+    recorder = AttentionPatternRecorder(model, layers=[1], heads=[0, 3], query_positions=[0, -1], mode="topk", top_k=4)
+    report = recorder.record(dataset, str(tmp_path))
+    reader = AttentionPatternReader(str(tmp_path))
+
+    for idx, task in enumerate(dataset):
+        entry = reader.item(idx)
+        expected = reference_patterns(model, task['clean']['prompt'])[[1]][:, [0, 3]][:, :, entry["query_positions"]]
+        dense = reader.dense(idx)
+        assert dense.shape == expected.shape
+
+        # the top-k keys of every row are kept (fp16), everything else is zero
+        values, indices = expected.topk(4, dim=-1)
+        assert torch.allclose(dense.gather(-1, indices), values, atol=1e-3)
+        assert ((dense != 0).sum(-1) <= 4).all()
+        assert (dense.sum(-1) <= 1 + 1e-3).all()
+
+    assert report["max_abs_error"] <= 1.0
+    assert report["compression_ratio"] > 1
@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from cpu_profile import Int8WeightOnlyLinear, reference_logits, accuracy_gate
+
+
+@pytest.fixture
+def model(make_tiny_model):
+    return make_tiny_model(d_model=64, d_head=16, d_vocab=128, n_ctx=64)
+
+
+prompts = [torch.tensor([[1, 5, 9, 13, 2, 7, 40, 3]]), torch.tensor([[1, 100, 22, 64]])]
+
+
+@pytest.mark.skipif(not hasattr(torch, "_weight_int8pack_mm"), reason="no weight-only int8 kernel in this torch build")
+def test_int8_linear_matches_matmul():
+    torch.manual_seed(0)
+    weight, bias = torch.randn(64, 128), torch.randn(128)  # [d_in, d_out], TransformerLens layout
+    x = torch.randn(3, 5, 64)
+    linear = Int8WeightOnlyLinear(weight, bias)
+
+    expected = x @ weight + bias
+    out = linear(x)
+    assert out.shape == expected.shape
+    # per-output-channel int8: error bounded by half a quantization step per weight
+    assert (out - expected).abs().max() < 0.05 * expected.abs().max()
+    assert linear.w_int8.dtype == torch.int8
+
+
+def test_accuracy_gate_passes_unchanged_model(model):
+    reference = reference_logits(model, prompts)
+    report = accuracy_gate(model, prompts, reference)
+    assert report["top1_agreement"] == 1.0
+    assert report["max_rel_error"] < 1e-4
+    assert report["positions"] == 12
+
+
+def test_accuracy_gate_rejects_perturbed_model(model):
+    reference = reference_logits(model, prompts)
+    with torch.no_grad():
+        model.unembed.W_U.add_(torch.randn_like(model.unembed.W_U))
+    with pytest.raises(RuntimeError):
+        accuracy_gate(model, prompts, reference)
+
+
+@pytest.mark.skipif(not hasattr(torch, "_weight_int8pack_mm"), reason="no weight-only int8 kernel in this torch build")
+def test_int8_overhead_matches_scheduler_estimate(model):
+    from cpu_profile import CPUProfile
+    from scheduler import estimate_int8_bytes
+
+    def total_bytes(model):
+        tensors = list(model.parameters()) + list(model.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    before = total_bytes(model)
+    CPUProfile(dtype=torch.float32, quantize_int8=True).apply(model)
+    assert total_bytes(model) - before == estimate_int8_bytes(model.cfg, torch.float32)
@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from logit_lens import LogitLensAnalyzer
+
+
+@pytest.fixture(scope="module")
+def model(make_tiny_model):
+    return make_tiny_model()
+
+
+dataset = [
+    {"id": 0, "task_class": "linear_symbolic", "clean": {"prompt": "Start with 5. Add 2.", "answer": "7"}},
+    {"id": 1, "task_class": "CBLG", "clean": {"prompt": "x=3, y=4. Gate", "answer": "3"}},
+    {"id": 2, "task_class": "linear_symbolic", "clean": {"prompt": "Start with 40. Subtract 28. A:", "answer": "12"}},
+    {"id": 3, "task_class": "linear_symbolic", "clean": {"prompt": "Start with 1.", "answer": "1"}},
+]
+
+
+def test_batched_matches_per_item(model):
+    analyzer = LogitLensAnalyzer(model, answer_prefix="")
+    single = analyzer.run(dataset, positions=(-1, -3), batch_size=1)
+    batched = analyzer.run(dataset, positions=(-1, -3), batch_size=4)
+    for task_class in single:
+        assert single[task_class]["ids"] == batched[task_class]["ids"]
+        assert torch.allclose(single[task_class]["answer_logit"], batched[task_class]["answer_logit"], atol=1e-4)
+        assert torch.equal(single[task_class]["answer_rank"], batched[task_class]["answer_rank"])
+
+
+def test_multi_token_answers_are_skipped(model):
+    results = LogitLensAnalyzer(model, answer_prefix="").run(dataset, batch_size=4)
+    assert results["linear_symbolic"]["ids"] == [0, 3]
+    assert results["linear_symbolic"]["skipped_ids"] == [2]
+    assert results["linear_symbolic"]["num_candidates"] == 3
+    assert results["linear_symbolic"]["answer_logit"].shape == (2, 2)
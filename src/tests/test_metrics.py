@@ -0,0 +1,59 @@
+import json
+import random
+
+from metrics import MultiPatternMatcher, StreamingMetrics, compute_metrics
+
+
+def test_matcher_agrees_with_substring_checks():
+    components = ["L5H1", "L5H10", "Head 5.1", "Aggregator Head"]
+    matcher = MultiPatternMatcher(components)
+    texts = [
+        "use L5H10 then Head 5.1 and the Aggregator Head",
+        "L5H1 and Head 5.1",
+        "nothing cited here",
+        "Aggregator HeadL5H10Head 5.1",
+    ]
+    for text in texts:
+        expected = all(comp in text for comp in components)
+        assert matcher.matches_all(text) == expected
+
+
+def test_streaming_metrics_per_group(tmp_path):
+    rng = random.Random(0)
+    path = tmp_path / "baseline_results_phi-1_5.jsonl"
+    rows = []
+    for i in range(500):
+        task_class = ["CBLG", "Parity_PAT"][i % 2]
+        rows.append({
+            "task_class": task_class,
+            "is_correct": rng.random() < (0.8 if task_class == "CBLG" else 0.3),
+            "generated_cot": "First use L5H1 then L7H2." if rng.random() < 0.5 else "no citation",
+        })
+    with open(path, "w") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+
+    # small chunks to exercise the streaming path
+    summary = compute_metrics(str(path), ["L5H1", "L7H2"], n_bootstrap=200, chunk_size=37)
+    assert [(s["model_name"], s["task_class"]) for s in summary] == [("phi-1_5", "CBLG"), ("phi-1_5", "Parity_PAT")]
+
+    for s in summary:
+        group = [r for r in rows if r["task_class"] == s["task_class"]]
+        accuracy = sum(r["is_correct"] for r in group) / len(group)
+        assert s["n"] == len(group)
+        assert abs(s["task_accuracy"] - accuracy) < 1e-9
+        lo, hi = s["task_accuracy_ci"]
+        assert lo <= accuracy <= hi
+
+
+def test_empty_components_are_always_compliant():
+    metrics = StreamingMetrics([], n_bootstrap=10)
+    metrics.update([{"task_class": "CBLG", "is_correct": True, "generated_cot": ""}])
+    assert metrics.summary()[0]["compliance_rate"] == 1.0
+
+
+def test_zero_weight_replicates_are_skipped():
+    # n=1: about 37% of Poisson replicates give the row zero weight; they must not count as rate 0
+    metrics = StreamingMetrics([], n_bootstrap=500)
+    metrics.update([{"task_class": "CBLG", "is_correct": True, "generated_cot": ""}])
+    assert metrics.summary()[0]["task_accuracy_ci"] == (1.0, 1.0)
@@ -0,0 +1,149 @@
+import os
+import re
+
+from pipeline import Pipeline
+
+calls = []
+
+def generate(inputs, params, runtime):
+    calls.append("generate")
+    return [f"the answer is {n * 2}." for n in range(params["n"])]
+
+def extract_v1(inputs, params, runtime):
+    calls.append("extract")
+    return [text.split()[-1] for text in inputs["completions"]]
+
+def extract_v2(inputs, params, runtime):
+    calls.append("extract")
+    return [text.split()[-1].rstrip(".") for text in inputs["completions"]]
+
+def score(inputs, params, runtime):
+    calls.append("score")
+    return sum(answer.isdigit() for answer in inputs["answers"])
+
+
+def build(cache_dir, extract, n=3):
+    pipeline = Pipeline(str(cache_dir))
+    pipeline.add("completions", generate, params={"n": n})
+    pipeline.add("extractions", extract, deps={"completions": "completions"})
+    pipeline.add("scores", score, deps={"answers": "extractions"})
+    return pipeline
+
+
+def test_second_run_is_fully_cached(tmp_path):
+    calls.clear()
+    assert build(tmp_path, extract_v1).run(["scores"])["scores"] == 0
+    assert calls == ["generate", "extract", "score"]
+
+    calls.clear()
+    assert build(tmp_path, extract_v1).run(["scores"])["scores"] == 0
+    assert calls == []
+
+
+def test_editing_extraction_keeps_generation(tmp_path):
+    build(tmp_path, extract_v1).run(["scores"])
+
+    calls.clear()
+    pipeline = build(tmp_path, extract_v2)
+    assert not pipeline.is_stale("completions")
+    assert pipeline.is_stale("extractions")
+    assert pipeline.run(["scores"])["scores"] == 3
+    assert calls == ["extract", "score"]
+
+
+def test_changing_params_invalidates_downstream(tmp_path):
+    build(tmp_path, extract_v2).run(["scores"])
+
+    calls.clear()
+    assert build(tmp_path, extract_v2, n=5).run(["scores"])["scores"] == 5
+    assert calls == ["generate", "extract", "score"]
+
+
+RULES = '''import re
+_NUMBER = re.compile(r"{pattern}")
+
+def extract(text):
+    return _NUMBER.findall(text)[-1]
+'''
+
+def extract_with_rules(inputs, params, runtime):
+    import extraction_rules
+    calls.append("extract")
+    return [extraction_rules.extract(text) for text in inputs["completions"]]
+
+
+def test_editing_module_level_regex_invalidates_extractions(tmp_path, monkeypatch):
+    import importlib
+    module_dir = tmp_path / "modules"
+    module_dir.mkdir()
+    monkeypatch.syspath_prepend(str(module_dir))
+    (module_dir / "extraction_rules.py").write_text(RULES.format(pattern=r"\d"))
+    import extraction_rules
+
+    def build_with_rules():
+        pipeline = Pipeline(str(tmp_path / "cache"))
+        pipeline.add("completions", generate, params={"n": 3})
+        pipeline.add("extractions", extract_with_rules, deps=["completions"], code=[extraction_rules])
+        return pipeline
+
+    assert build_with_rules().run(["extractions"])["extractions"] == ["0", "2", "4"]
+
+    # only the regex changes, the function body using it does not
+    (module_dir / "extraction_rules.py").write_text(RULES.format(pattern=r"\d+"))
+    importlib.reload(extraction_rules)
+
+    calls.clear()
+    pipeline = build_with_rules()
+    assert not pipeline.is_stale("completions")
+    assert pipeline.is_stale("extractions")
+    assert pipeline.run(["extractions"])["extractions"] == ["0", "2", "4"]
+    assert calls == ["extract"]
+
+
+def touch_artifacts(pipeline):
+    """Marks every stage as computed without running it (the real stages need a model)."""
+    for name in pipeline.stages:
+        path = pipeline._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "wb").close()
+
+
+def experiment_stages(pipeline, prefix):
+    return [name for name in pipeline.stages if name.startswith(prefix)]
+
+
+def test_editing_fallback_extractor_keeps_real_completions(tmp_path, monkeypatch):
+    import answer_extraction
+    from pipeline import build_experiment_pipeline
+
+    touch_artifacts(build_experiment_pipeline(["org/model"], cache_dir=str(tmp_path)))
+
+    monkeypatch.setattr(answer_extraction, "_NUMERIC_EXPLICIT", re.compile(r"(?:answer|result):\s*(\-?\d+)"))
+    pipeline = build_experiment_pipeline(["org/model"], cache_dir=str(tmp_path))
+    assert not any(pipeline.is_stale(name) for name in experiment_stages(pipeline, "completions/"))
+    assert not any(pipeline.is_stale(name) for name in experiment_stages(pipeline, "patching/"))
+    assert all(pipeline.is_stale(name) for name in experiment_stages(pipeline, "extractions/"))
+    assert all(pipeline.is_stale(name) for name in experiment_stages(pipeline, "scores/"))
+
+
+def test_editing_streaming_pattern_invalidates_real_completions(tmp_path, monkeypatch):
+    import answer_extraction
+    from pipeline import build_experiment_pipeline
+
+    touch_artifacts(build_experiment_pipeline(["org/model"], cache_dir=str(tmp_path)))
+
+    patterns = dict(answer_extraction.FINAL_PATTERNS, CBLG=re.compile(r"answer:\s*(-?\d+)(?=\D)"))
+    monkeypatch.setattr(answer_extraction, "FINAL_PATTERNS", patterns)
+    pipeline = build_experiment_pipeline(["org/model"], cache_dir=str(tmp_path))
+    assert all(pipeline.is_stale(name) for name in experiment_stages(pipeline, "completions/"))
+    assert not pipeline.is_stale("prompts")
+
+
+def test_int8_setting_is_part_of_model_stage_keys():
+    from pipeline import build_experiment_pipeline
+
+    plain = build_experiment_pipeline(["org/model"], dtype="bfloat16")
+    int8 = build_experiment_pipeline(["org/model"], dtype="bfloat16", quantize_int8=True)
+    for name in experiment_stages(plain, "completions/") + experiment_stages(plain, "patching/"):
+        assert plain.key(name) != int8.key(name)
+    assert plain.key("prompts") == int8.key("prompts")
@@ -0,0 +1,55 @@
+import torch
+
+from probes import ActivationShards, ProbeActivationCollector, probe_examples, fit_ridge_probes, fit_logistic_probes
+
+
+def synthetic_shards(store_dir=None, n=240, n_layers=3, n_pos=2, d=8, informative=(1, 0)):
+    """Label is linearly readable at one (layer, position) only, noise everywhere else."""
+    g = torch.Generator().manual_seed(0)
+    y = torch.randint(0, 2, (n,), generator=g)
+    X = torch.randn(n, n_layers, n_pos, d, generator=g)
+    X[:, informative[0], informative[1], 0] += 4 * (y.float() * 2 - 1)
+
+    shards = ActivationShards(store_dir)
+    folds = torch.arange(n) % 4
+    for start in range(0, n, 100):  # several shards, the last one short
+        end = start + 100
+        shards.append(X[start:end].half(), y[start:end, None], folds[start:end])
+    return shards
+
+
+def test_ridge_probes_find_informative_site(tmp_path):
+    shards = synthetic_shards(store_dir=str(tmp_path))
+    acc, std = fit_ridge_probes(shards, 0, n_classes=2, n_folds=4, max_memory_bytes=1)  # one group per block
+    acc = acc.reshape(3, 2)
+    assert acc[1, 0] > 0.95
+    assert acc.flatten().argmax().item() == 2
+    assert (acc.flatten()[[0, 1, 3, 4, 5]] < 0.8).all()
+
+
+def test_logistic_probes_find_informative_site():
+    shards = synthetic_shards()
+    acc, _ = fit_logistic_probes(shards, 0, n_classes=2, n_folds=4, epochs=30, lr=5e-2)
+    acc = acc.reshape(3, 2)
+    assert acc[1, 0] > 0.95
+    assert acc.flatten().argmax().item() == 2
+
+
+def test_pairs_share_a_fold():
+    items = [{"clean": {"prompt": f"c{i}", "gate_state": "Even"},
+              "corrupt": {"prompt": f"x{i}", "gate_state": "Odd"}} for i in range(6)]
+    examples, classes = probe_examples(items, ["gate_state"], n_folds=3)
+    assert classes == {"gate_state": ["Even", "Odd"]}
+    assert len(examples) == 12
+    for clean, corrupt in zip(examples[::2], examples[1::2]):
+        assert clean[2] == corrupt[2]
+        assert (clean[1], corrupt[1]) == ([0], [1])
+
+
+def test_batched_activations_match_per_item(make_tiny_model):
+    model = make_tiny_model()
+    examples = [(prompt, [0], 0) for prompt in ["x=3, y=4. Gate", "short", "Start with 40. Subtract 28."]]
+    collector = ProbeActivationCollector(model, positions=(-1, -2))
+    single = torch.cat([shard["X"] for shard in collector.collect(examples, batch_size=1, shard_size=1)])
+    batched = next(iter(collector.collect(examples, batch_size=3)))["X"]
+    assert torch.allclose(single.float(), batched.float(), atol=1e-2)
@@ -0,0 +1,133 @@
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from scheduler import MemoryBudgetScheduler, estimate_param_bytes, estimate_activation_bytes, estimate_int8_bytes
+
+MIB = 1024 ** 2
+
+
+def make_cfg(n_layers=2, d_model=64, n_ctx=512, **kwargs):
+    settings = dict(
+        n_layers=n_layers, d_model=d_model, d_head=16, n_heads=d_model // 16, d_mlp=4 * d_model,
+        d_vocab=100, n_ctx=n_ctx, act_fn="gelu", normalization_type="LN", device="cpu", seed=0,
+    )
+    settings.update(kwargs)
+    return HookedTransformerConfig(**settings)
+
+
+def actual_bytes(cfg):
+    model = HookedTransformer(cfg)
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def test_param_estimate_matches_built_model():
+    # n_ctx is large relative to the weights, so the causal mask buffers dominate
+    for cfg in [
+        make_cfg(),
+        make_cfg(positional_embedding_type="rotary", normalization_type="RMS", act_fn="silu",
+                 gated_mlp=True, n_key_value_heads=2),
+        make_cfg(attn_only=True, n_layers=3),
+    ]:
+        estimate, actual = estimate_param_bytes(cfg, torch.float32), actual_bytes(cfg)
+        assert abs(estimate - actual) <= 0.01 * actual, (cfg.positional_embedding_type, estimate, actual)
+
+
+def test_pick_batch_size_is_largest_power_of_two_that_fits():
+    cfg = make_cfg()
+    weights = estimate_param_bytes(cfg, torch.float32)
+    budget = weights + estimate_activation_bytes(cfg, 8, 200, torch.float32) + 1
+    scheduler = MemoryBudgetScheduler(budget, dtype=torch.float32, reserve_fraction=0.0)
+    assert scheduler.pick_batch_size(cfg, weights, 200) == 8
+    assert scheduler.pick_batch_size(cfg, budget, 200) == 0
+
+
+def jobs_for(model_name, task_classes=("CBLG", "linear_symbolic")):
+    return [{"model_name": model_name, "task_class": c, "prompt_lengths": [80, 100]} for c in task_classes]
+
+
+def test_plan_packs_models_without_cutting_batch_size():
+    small, large = make_cfg(), make_cfg(n_layers=4, d_model=128)
+    jobs = jobs_for("small") + jobs_for("large")
+
+    # room for both models next to the largest batch: one wave, both resident
+    roomy = MemoryBudgetScheduler(4096 * MIB, dtype=torch.float32, max_batch_size=4, reserve_fraction=0.0)
+    roomy.add_model("small", small)
+    roomy.add_model("large", large)
+    plan = roomy.plan(jobs)
+    assert [wave["models"] for wave in plan["waves"]] == [["large", "small"]]
+    assert all(job["batch_size"] == 4 for job in plan["waves"][0]["jobs"])
+    assert plan["skipped"] == []
+
+    # room for the large model at batch 4 but not both: separate waves, batch sizes unchanged
+    seq_len = 100 + roomy.max_new_tokens
+    budget = estimate_param_bytes(large, torch.float32) + estimate_activation_bytes(large, 4, seq_len, torch.float32) + 1
+    tight = MemoryBudgetScheduler(budget, dtype=torch.float32, max_batch_size=4, reserve_fraction=0.0)
+    tight.add_model("small", small)
+    tight.add_model("large", large)
+    plan = tight.plan(jobs)
+    assert [wave["models"] for wave in plan["waves"]] == [["large"], ["small"]]
+    for wave in plan["waves"]:
+        assert [job["task_class"] for job in wave["jobs"]] == ["CBLG", "linear_symbolic"]
+        assert all(job["batch_size"] == 4 for job in wave["jobs"])
+        assert all(job["planned_peak_bytes"] <= budget for job in wave["jobs"])
+
+
+def test_plan_skips_models_that_never_fit():
+    scheduler = MemoryBudgetScheduler(1 * MIB, dtype=torch.float32, reserve_fraction=0.0)
+    scheduler.add_model("large", make_cfg(n_layers=4, d_model=128))
+    scheduler.add_model("tiny", make_cfg(n_layers=1, d_model=16, n_ctx=64, d_vocab=20))
+    plan = scheduler.plan(jobs_for("large") + jobs_for("tiny", ["CBLG"]))
+    assert [job["model_name"] for job in plan["skipped"]] == ["large", "large"]
+    assert [wave["models"] for wave in plan["waves"]] == [["tiny"]]
+
+
+def test_plan_accounts_for_load_peak():
+    cfg = make_cfg(n_layers=4, d_model=128)
+    seq_len = 100  # max_new_tokens=0
+    # fits at fp16 with room for batch 1, but not while the fp32 weights are materialized
+    budget = estimate_param_bytes(cfg, torch.float16) + estimate_activation_bytes(cfg, 1, seq_len, torch.float16) + 1
+    assert estimate_param_bytes(cfg, torch.float32) > budget
+
+    direct = MemoryBudgetScheduler(budget, dtype=torch.float16, max_new_tokens=0, reserve_fraction=0.0)
+    direct.add_model("large", cfg)
+    assert direct.plan(jobs_for("large"))["skipped"] == []
+
+    via_fp32 = MemoryBudgetScheduler(budget, dtype=torch.float16, max_new_tokens=0, reserve_fraction=0.0,
+                                     load_dtype=torch.float32)
+    via_fp32.add_model("large", cfg)
+    plan = via_fp32.plan(jobs_for("large"))
+    assert plan["waves"] == []
+    assert len(plan["skipped"]) == 2
+
+
+def test_run_reports_per_job_cpu_peak(monkeypatch):
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: False)
+    scheduler = MemoryBudgetScheduler(4096 * MIB, dtype=torch.float32, max_batch_size=1, reserve_fraction=0.0)
+    scheduler.add_model("small", make_cfg())
+    plan = scheduler.plan(jobs_for("small"))
+
+    def run_job(model, job, batch_size):
+        if job["task_class"] == "CBLG":
+            buffer = bytearray(256 * MIB)
+            buffer[::4096] = b"\1" * len(buffer[::4096])  # touch every page so it is resident
+
+    reports = scheduler.run(plan, load_model=lambda name: object(), run_job=run_job)
+    assert [r["task_class"] for r in reports] == ["CBLG", "linear_symbolic"]
+    assert all(r["status"] == "ok" for r in reports)
+    if reports[1]["peak_scope"] == "job":
+        # the second job's peak does not inherit the first job's allocation
+        assert reports[1]["actual_peak_bytes"] < reports[0]["actual_peak_bytes"] - 128 * MIB
+    else:
+        assert reports[1]["actual_peak_bytes"] >= reports[0]["actual_peak_bytes"]
+
+
+def test_int8_weights_count_as_resident():
+    cfg = make_cfg()
+    plain = MemoryBudgetScheduler(4096 * MIB, dtype=torch.float32, max_batch_size=1)
+    int8 = MemoryBudgetScheduler(4096 * MIB, dtype=torch.float32, max_batch_size=1, int8_weights=True)
+    for scheduler in [plain, int8]:
+        scheduler.add_model("small", cfg)
+    plain_wave = plain.plan(jobs_for("small"))["waves"][0]
+    int8_wave = int8.plan(jobs_for("small"))["waves"][0]
+    assert int8_wave["resident_bytes"] - plain_wave["resident_bytes"] == estimate_int8_bytes(cfg, torch.float32)
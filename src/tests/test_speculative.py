@@ -0,0 +1,49 @@
+import pytest
+import torch
+
+from decoding import greedy_generate, speculative_generate
+
+prompt = torch.tensor([[1, 5, 9, 13, 2, 7]])
+
+
+# two tiny models that share a vocabulary
+@pytest.fixture(scope="module")
+def target(make_tiny_model):
+    return make_tiny_model(n_layers=3, d_model=64, seed=0)
+
+
+@pytest.fixture(scope="module")
+def draft(make_tiny_model):
+    return make_tiny_model(n_layers=1, d_model=32, seed=1)
+
+
+def test_speculative_matches_target_only_greedy(target, draft):
+    reference, _ = greedy_generate(target, prompt, max_new_tokens=30)
+    for k in [1, 3, 5]:
+        output, stats = speculative_generate(target, draft, prompt, max_new_tokens=30, num_draft_tokens=k)
+        assert output == reference
+        assert stats["new_tokens"] == 30
+        assert 0.0 <= stats["acceptance_rate"] <= 1.0
+
+
+def test_greedy_matches_transformer_lens_generate(target):
+    reference, _ = greedy_generate(target, prompt, max_new_tokens=20)
+    tl_output = target.generate(prompt, max_new_tokens=20, do_sample=False, stop_at_eos=False, verbose=False)
+    assert tl_output[0, prompt.shape[1]:].tolist() == reference
+
+
+def test_identical_draft_accepts_everything(target):
+    output, stats = speculative_generate(target, target, prompt, max_new_tokens=25, num_draft_tokens=4)
+    reference, _ = greedy_generate(target, prompt, max_new_tokens=25)
+    assert output == reference
+    assert stats["acceptance_rate"] == 1.0
+    # every verification pass commits k + 1 tokens
+    assert stats["target_forward_passes"] < 25
+
+
+def test_stops_at_eos(target, draft):
+    reference, _ = greedy_generate(target, prompt, max_new_tokens=30)
+    eos = reference[10]
+    output, _ = speculative_generate(target, draft, prompt, max_new_tokens=30, num_draft_tokens=4, eos_token_id=eos)
+    assert output[-1] == eos
+    assert output == reference[:reference.index(eos) + 1]